@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+import argparse
+import datetime
+import os
+import random
+import subprocess
+import sys
+import time
+import timeit
+
+import numpy
+
+from fake_youtrack import FakeYouTrack
+from main import fetch_projects
+from youtrack.flow import cumulative_flow
+from youtrack.forecast import MonteCarloForecast, daily_throughput
+from youtrack.kanban_metrics import StateChange, KanbanAwareYouTrackConnection
+from youtrack.quantiles import PERCENTILES, percentile_breakdown
+from youtrack.summary import SummaryStatistics
+
+
+class SyntheticIssue(object):
+    def __init__(self, number, cycle_time_start, cycle_time):
+        self.issue_id = 'BENCH-%d' % number
+        self.cycle_time_start = cycle_time_start
+        self.cycle_time = cycle_time
+        self.cycle_time_end = self.resolved_date = cycle_time_start + cycle_time
+        created = cycle_time_start - cycle_time / 2
+        review = cycle_time_start + cycle_time * 2 / 3
+        self.state_changes = [StateChange('Open', 'In Progress', cycle_time_start, cycle_time_start - created),
+                              StateChange('In Progress', 'Review', review, review - cycle_time_start),
+                              StateChange('Review', 'Complete', self.cycle_time_end, self.cycle_time_end - review)]
+
+    def __str__(self):
+        return '[%s], cycle time: %s' % (self.issue_id, self.cycle_time)
+
+
+def synthetic_issues(size, seed=42, days=3 * 365):
+    generator = random.Random(seed)
+    start = datetime.datetime(2015, 1, 1)
+    return [SyntheticIssue(number, start + datetime.timedelta(minutes=generator.randint(0, days * 24 * 60)),
+                           datetime.timedelta(hours=generator.expovariate(1 / 200.0)))
+            for number in range(size)]
+
+
+def legacy_metrics(issues):
+    cycletimes = [issue.cycle_time.days for issue in issues]
+    issue_to_print = [issue for issue in issues]
+    buckets = []
+    for quantile in PERCENTILES:
+        quantile_cycle_time = numpy.percentile(cycletimes, quantile)
+        bucket = []
+        for issue in issue_to_print:
+            if issue.cycle_time.days <= quantile_cycle_time:
+                bucket.append(issue)
+                issue_to_print.remove(issue)
+        buckets.append(bucket)
+    return buckets
+
+
+def report(name, size, statement, repeat, unit='issues'):
+    seconds = min(timeit.repeat(statement, number=1, repeat=repeat))
+    print '%-20s %8d %s: %8.2f ms' % (name, size, unit, seconds * 1000)
+    return seconds
+
+
+def breakdown(sizes, repeat):
+    for size in sizes:
+        issues = synthetic_issues(size)
+        seconds = report('percentile_breakdown', size, lambda: percentile_breakdown(issues), repeat)
+        print '%-20s %8d issues: %8.2f us per n log n' % ('', size, seconds * 1e6 / (size * numpy.log2(size)))
+        if size <= 10000:
+            report('legacy metrics', size, lambda: legacy_metrics(issues), repeat)
+
+
+def cfd(sizes, repeat):
+    then = datetime.datetime(2015, 1, 1)
+    now = then + datetime.timedelta(days=90)
+    for size in sizes:
+        issues = synthetic_issues(size // 3, days=90)
+        report('cumulative_flow', size, lambda: cumulative_flow(issues, then, now), repeat, 'transitions')
+
+
+def forecast(sizes, repeat):
+    then = datetime.datetime(2015, 1, 1)
+    now = then + datetime.timedelta(days=90)
+    throughput = daily_throughput(synthetic_issues(300, days=90), then, now)
+    for trials in sizes:
+        for processes in (None, 4):
+            monte_carlo = MonteCarloForecast(throughput, trials, processes)
+            report('items by (%s)' % processes, trials, lambda: monte_carlo.items_by(30), repeat, 'trials')
+            report('days until (%s)' % processes, trials, lambda: monte_carlo.days_until(100), repeat, 'trials')
+
+
+def pipeline(sizes, repeat, latency=0.02, workers=8):
+    projects = ['PROJECT%d' % number for number in range(6)]
+    for size in sizes:
+        fake_youtrack = FakeYouTrack(projects, size, latency).start()
+        try:
+            sequential = KanbanAwareYouTrackConnection(fake_youtrack.url, 'benchmark', 'benchmark')
+            parallel = KanbanAwareYouTrackConnection(fake_youtrack.url, 'benchmark', 'benchmark', workers=workers)
+            report('sequential', size, lambda: fetch_projects(sequential, projects, None), repeat,
+                   'issues per project')
+            report('slowest project', size, lambda: fetch_projects(parallel, projects[:1], None, workers), repeat,
+                   'issues per project')
+            report('pipeline', size, lambda: fetch_projects(parallel, projects, None, workers), repeat,
+                   'issues per project')
+        finally:
+            fake_youtrack.stop()
+
+
+def aggregate(issues, now, then):
+    # what a dashboard computes from an issue set, without the bokeh figures
+    summary = SummaryStatistics(issues, now, then)
+    return summary, percentile_breakdown(issues), cumulative_flow(issues, then, now)
+
+
+def legacy_dashboard(yt, projects, now, then):
+    # projects_metrics before: sequential fetches, aggregated again after every project
+    issues = []
+    for project in projects:
+        issues.extend(yt.get_cycle_time_issues(project, 1000))
+        result = aggregate(issues, now, then)
+    return result
+
+
+def dashboard(sizes, repeat, latency=0.02):
+    projects = ('MOBILE', 'GP', 'MSDK')
+    now = datetime.datetime(2016, 9, 30)
+    then = now - datetime.timedelta(days=90)
+    for size in sizes:
+        fake_youtrack = FakeYouTrack(projects, size, latency, end=now).start()
+        try:
+            yt = KanbanAwareYouTrackConnection(fake_youtrack.url, 'benchmark', 'benchmark')
+            report('legacy dashboard', size, lambda: legacy_dashboard(yt, projects, now, then), repeat,
+                   'issues per project')
+            report('parallel dashboard', size, lambda: aggregate(
+                [issue for project_issues in fetch_projects(yt, projects, None, len(projects)).values()
+                 for issue in project_issues], now, then), repeat, 'issues per project')
+        finally:
+            fake_youtrack.stop()
+
+
+def first_output(command):
+    start = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+    process.stdout.readline()
+    seconds = time.time() - start
+    process.communicate()
+    return seconds
+
+
+def startup(sizes, repeat, heavy_modules=('numpy', 'httplib2', 'matplotlib', 'youtrack.kanban_metrics')):
+    # time from process start to the first line of output, for python 2 there is no -X importtime
+    probe = 'import sys, main; print " ".join(module for module in %r if module in sys.modules)' % (heavy_modules,)
+    loaded = subprocess.check_output([sys.executable, '-c', probe],
+                                     cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    print 'loaded by import main: %s' % (loaded or 'nothing heavy')
+    report('import main', 1, lambda: first_output([sys.executable, '-c', 'import main; print']), repeat, 'process')
+    report('main.py --help', 1, lambda: first_output([sys.executable, 'main.py', '--help']), repeat, 'process')
+    projects = ['PROJECT%d' % number for number in range(2)]
+    for size in sizes:
+        fake_youtrack = FakeYouTrack(projects, size).start()
+        try:
+            for chart in ('basic', 'metrics'):
+                command = [sys.executable, 'main.py', '--url', fake_youtrack.url, '--username', 'benchmark',
+                           '--password', 'benchmark'] + projects + [chart]
+                report('main.py %s' % chart, size, lambda: first_output(command), repeat, 'issues per project')
+        finally:
+            fake_youtrack.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=('breakdown', 'cfd', 'forecast', 'pipeline', 'startup', 'dashboard'),
+                        help='benchmark to run')
+    parser.add_argument('--sizes', dest='sizes', nargs='+', type=int, default=(1000, 10000, 100000),
+                        help='number of synthetic issues (transitions for cfd, trials for forecast, '
+                             'issues per project for pipeline, startup and dashboard)')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3, help='repetitions per measurement')
+    args = parser.parse_args()
+    if args.benchmark == 'breakdown':
+        breakdown(args.sizes, args.repeat)
+    elif args.benchmark == 'cfd':
+        cfd(args.sizes, args.repeat)
+    elif args.benchmark == 'forecast':
+        forecast(args.sizes, args.repeat)
+    elif args.benchmark == 'pipeline':
+        pipeline(args.sizes, args.repeat)
+    elif args.benchmark == 'startup':
+        startup(args.sizes, args.repeat)
+    elif args.benchmark == 'dashboard':
+        dashboard(args.sizes, args.repeat)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+import argparse
+import datetime
+import re
+import socket
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from xml.sax.saxutils import quoteattr
+
+
+def to_millis(datetime_value):
+    # local time, the counterpart of kanban_metrics.millis_to_datetime
+    return int(time.mktime(datetime_value.timetuple())) * 1000 + datetime_value.microsecond // 1000
+
+
+class FakeIssue(object):
+    def __init__(self, project, number, created, resolved=True):
+        self.id = '%s-%d' % (project, number)
+        self.created = created
+        self.started = created + datetime.timedelta(days=1)
+        self.resolved = self.started + datetime.timedelta(days=1 + number % 10, hours=number % 24) if resolved else None
+        self.updated = self.resolved or self.started
+        self.moves = []
+
+    def move(self, updated, old_state, new_state):
+        self.moves.append((updated, old_state, new_state))
+        self.updated = updated
+
+    def to_xml(self):
+        return '<issue id=%s><field name="created"><value>%d</value></field>' \
+               '<field name="updated"><value>%d</value></field></issue>' % (
+                   quoteattr(self.id), to_millis(self.created), to_millis(self.updated))
+
+    def changes_xml(self):
+        changes = [state_change_xml(self.started, 'Open', 'In Progress')]
+        changes.extend(state_change_xml(*move) for move in self.moves)
+        if self.resolved:
+            changes.append(state_change_xml(self.resolved, 'In Progress', 'Complete',
+                                            '<field name="resolved"><oldValue></oldValue><newValue>%d</newValue>'
+                                            '</field>' % to_millis(self.resolved)))
+        return '<changes>%s</changes>' % ''.join(changes)
+
+
+def state_change_xml(updated, old_state, new_state, extra_fields=''):
+    return '<change><field name="updated"><value>%d</value></field>' \
+           '<field name="State"><oldValue>%s</oldValue><newValue>%s</newValue></field>%s</change>' % (
+               to_millis(updated), old_state, new_state, extra_fields)
+
+
+def resolved_in_range(issues, issue_filter):
+    history_range = re.search(r'resolved date:(\S+) \.\. (\S+)', issue_filter)
+    if not history_range:
+        return issues
+    first_day, last_day = sorted(datetime.datetime.strptime(day, '%Y-%m-%d').date() for day in history_range.groups())
+    return [issue for issue in issues if first_day <= issue.resolved.date() <= last_day]
+
+
+class FakeYouTrack(object):
+    """
+    Minimal YouTrack REST server on localhost with generated issues and a configurable latency per request.
+    Serves login, project list, issues by project and issue change histories.
+    """
+
+    def __init__(self, projects=('BACKEND',), issues_per_project=50, latency=0.0, end=None, open_issues_per_project=0):
+        self.latency = latency
+        self.requests = 0
+        self.history_requests = 0
+        self._lock = threading.Lock()
+        end = end or datetime.datetime.now()
+        self.projects = {}
+        self.open_issues = {}
+        self.issues = {}
+        for project in projects:
+            self.projects[project] = [FakeIssue(project, number, end - datetime.timedelta(days=20, hours=number * 7))
+                                      for number in range(issues_per_project)]
+            self.open_issues[project] = [FakeIssue(project, number, end - datetime.timedelta(days=number + 2), False)
+                                         for number in range(issues_per_project,
+                                                             issues_per_project + open_issues_per_project)]
+            self.issues.update((issue.id, issue) for issue in self.projects[project] + self.open_issues[project])
+        self._server = None
+        self.url = None
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), FakeYouTrackHandler)
+        self._server.fake = self
+        self.url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.stop_handlers()
+        self._server.server_close()
+
+    def count_request(self, history=False):
+        with self._lock:
+            self.requests += 1
+            if history:
+                self.history_requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self._handlers = {}
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = True
+        self._handlers[request] = thread
+        thread.start()
+
+    def shutdown_request(self, request):
+        self._handlers.pop(request, None)
+        HTTPServer.shutdown_request(self, request)
+
+    def stop_handlers(self):
+        # wake up handlers waiting on idle keep-alive connections and wait for them to terminate
+        for request, thread in self._handlers.items():
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join(1)
+
+    def handle_error(self, request, client_address):
+        # clients dropping keep-alive connections are expected
+        pass
+
+
+class FakeYouTrackHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send every response in one segment, otherwise delayed acks add 40ms per request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.server.fake.count_request()
+        if self.path.startswith('/rest/user/login'):
+            self._respond(200, '<login>ok</login>', {'Set-Cookie': 'YTSESSION=fake'})
+        else:
+            self._respond(404, '<error>not found</error>')
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urlparse.urlparse(self.path)
+        parts = url.path.split('/')
+        fake.count_request(history=parts[-1] == 'changes')
+        if url.path == '/rest/project/all':
+            self._respond(200, '<projects>%s</projects>' % ''.join(
+                '<project shortName=%s name=%s/>' % (quoteattr(project), quoteattr(project.title()))
+                for project in sorted(fake.projects)))
+        elif url.path.startswith('/rest/issue/byproject/') and parts[4] in fake.projects:
+            query = urlparse.parse_qs(url.query)
+            after = int(query.get('after', ['0'])[0])
+            maximum = int(query.get('max', ['10'])[0])
+            issue_filter = query.get('filter', [''])[0]
+            if '#Unresolved' in issue_filter:
+                issues = fake.open_issues[parts[4]]
+            else:
+                issues = resolved_in_range(fake.projects[parts[4]], issue_filter)
+            self._respond(200, '<issues>%s</issues>' % ''.join(
+                issue.to_xml() for issue in issues[after:after + maximum]))
+        elif len(parts) == 5 and parts[4] == 'changes' and parts[3] in fake.issues:
+            self._respond(200, fake.issues[parts[3]].changes_xml())
+        else:
+            self._respond(404, '<error>not found</error>')
+
+    def _respond(self, status, content, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml; charset=UTF-8')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('projects', nargs='+', help='projects to serve')
+    parser.add_argument('--issues', dest='issues', default=50, type=int, help='issues per project')
+    parser.add_argument('--latency', dest='latency', default=0.05, type=float, help='seconds per request')
+    args = parser.parse_args()
+    fake_youtrack = FakeYouTrack(args.projects, args.issues, args.latency).start()
+    print 'serving %s on %s' % (args.projects, fake_youtrack.url)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fake_youtrack.stop()
@@ -3,13 +3,17 @@ import argparse
 import datetime
 import logging
 import math
+import os
 import sys
+import time
 from collections import Counter
-from operator import attrgetter
+from itertools import chain
+from multiprocessing import Pool
 
-import numpy
 
-from youtrack.kanban_metrics import KanbanAwareYouTrackConnection
+CHARTS = ('histogram', 'control', 'percentile', 'states', 'wip', 'cfd')
+# change histories fetched concurrently per project when warming the cache
+WARM_WORKERS = 8
 
 
 def to_date_fetch_query(datetime_value):
@@ -17,6 +21,8 @@ def to_date_fetch_query(datetime_value):
 
 
 def main(arguments):
+    # numpy, httplib2 and the engines are imported on first use, so --help and argument errors stay fast
+    from youtrack.kanban_metrics import KanbanAwareYouTrackConnection, HistoryStore
     if arguments.verbose > 1:
         logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
     elif arguments.verbose == 1:
@@ -24,18 +30,56 @@ def main(arguments):
     else:
         logging.basicConfig(stream=sys.stdout, level=logging.WARN)
 
-    yt = KanbanAwareYouTrackConnection('https://tickets.i.gini.net', arguments.username, arguments.password)
+    if arguments.chart == 'cache-stats':
+        cache_stats(arguments)
+        return
+    cache = None
+    if arguments.cachedir and not arguments.nocache:
+        from youtrack.issue_cache import IssueCache
+        cache = IssueCache(arguments.cachedir, arguments.cacheage)
+
+    history_store = HistoryStore(arguments.history_store) if arguments.history_store else None
+    yt = KanbanAwareYouTrackConnection(arguments.url, arguments.username, arguments.password, cache=cache,
+                                       retain_changes=not arguments.release_changes, workers=arguments.workers,
+                                       history_store=history_store)
     if arguments.history_from:
         now = datetime.datetime.strptime(arguments.history_from, '%Y-%m-%d')
     else:
         now = datetime.datetime.now()
     then = now - datetime.timedelta(days=arguments.history_age)
 
-    issues = []
-    for project in arguments.projects:
-        issues.extend(yt.get_cycle_time_issues(project, 1000,
-                                               history_range=(to_date_fetch_query(now), to_date_fetch_query(then))))
-
+    try:
+        if arguments.chart == 'export':
+            export(yt, arguments.projects, (to_date_fetch_query(now), to_date_fetch_query(then)), arguments)
+        elif arguments.chart == 'batch':
+            batch(yt, arguments, now, then)
+        elif arguments.chart == 'compare':
+            compare(yt, arguments, parse_windows(arguments.windows or [to_date_fetch_query(now)],
+                                                 arguments.history_age))
+        elif arguments.chart == 'warm':
+            warm(yt, cache, arguments, now, then)
+        else:
+            report(yt, arguments, now, then)
+    finally:
+        if history_store:
+            history_store.close()
+        if cache:
+            cache.record_run(arguments.chart)
+
+
+def report(yt, arguments, now, then):
+    project_issues = fetch_projects(yt, arguments.projects, (to_date_fetch_query(now), to_date_fetch_query(then)),
+                                    arguments.workers, arguments.items)
+    issues = [issue for project in arguments.projects for issue in project_issues[project]]
+
+    if len(arguments.projects) > 1:
+        for project in arguments.projects:
+            print '[%s]' % project
+            if project_issues[project]:
+                base(project_issues[project], now, then)
+            else:
+                print 'no finished issues'
+        print arguments.projects
     base(issues, now, then)
 
     chart_title = '%s %s' % (arguments.projects, (to_date_fetch_query(then), to_date_fetch_query(now)))
@@ -43,21 +87,187 @@ def main(arguments):
     chart_filename = None
     if arguments.save_chart:
         chart_filename = '%s_%s-%s.png' % (arguments.projects, to_date_fetch_query(then), to_date_fetch_query(now))
-    if arguments.chart == 'histogram':
-        histogram(issues, chart_title, chart_filename)
-    elif arguments.chart == 'control':
-        control_chart(issues, chart_title, chart_filename)
+    if arguments.chart in CHARTS:
+        render(arguments.chart, issues, now, then, chart_title, chart_filename, arguments.chart_log,
+               arguments.point_budget)
     elif arguments.chart == 'metrics':
         metrics(issues)
     elif arguments.chart == 'basic':
         pass
-    elif arguments.chart == 'percentile':
-        percentile(issues, chart_title, chart_filename)
-    elif arguments.chart == 'states':
-        states(issues, chart_title, chart_filename)
+    elif arguments.chart == 'forecast':
+        forecast(issues, now, then, arguments)
+    elif arguments.chart == 'aging':
+        aging(yt, arguments.projects, issues, now, arguments.items, arguments.workers)
+
+
+def render(chart, issues, now, then, chart_title, chart_file, chart_log=False, point_budget=None):
+    if chart == 'histogram':
+        histogram(issues, chart_title, chart_file, chart_log)
+    elif chart == 'control':
+        control_chart(issues, chart_title, chart_file, chart_log, point_budget)
+    elif chart == 'percentile':
+        percentile(issues, chart_title, chart_file, chart_log)
+    elif chart == 'states':
+        states(issues, chart_title, chart_file)
+    elif chart == 'wip':
+        from youtrack.flow import daily_flow
+        wip(daily_flow(issues, then, now), chart_title, chart_file)
+    elif chart == 'cfd':
+        from youtrack.flow import cumulative_flow
+        cfd(cumulative_flow(issues, then, now), chart_title, chart_file)
+
+
+def render_group(job):
+    # every chart of one group, so that its issues are sent to the worker once
+    issues, now, then, chart_title, chart_file, chart_log, point_budget = job
+    for chart in CHARTS:
+        render(chart, issues, now, then, chart_title, chart_file, chart_log, point_budget)
+    return len(CHARTS)
+
+
+def batch(yt, arguments, now, then):
+    # fetch once, then render every chart of every project on a pool of headless matplotlib processes
+    import matplotlib
+    matplotlib.use('Agg')
+    yt.retain_changes = False
+    project_issues = fetch_projects(yt, arguments.projects, (to_date_fetch_query(now), to_date_fetch_query(then)),
+                                    arguments.workers, arguments.items)
+    groups = [(project, project_issues[project]) for project in arguments.projects if project_issues[project]]
+    if len(arguments.projects) > 1 and groups:
+        groups.append(('_'.join(arguments.projects),
+                       [issue for project in arguments.projects for issue in project_issues[project]]))
+    if not os.path.isdir(arguments.output_dir):
+        os.makedirs(arguments.output_dir)
+
+    jobs = []
+    for group, issues in groups:
+        chart_title = '%s %s' % (group, (to_date_fetch_query(then), to_date_fetch_query(now)))
+        chart_file = os.path.join(arguments.output_dir, '%s_%s-%s.png' % (group, to_date_fetch_query(then),
+                                                                           to_date_fetch_query(now)))
+        jobs.append((issues, now, then, chart_title, chart_file, arguments.chart_log, arguments.point_budget))
+    pool = Pool(arguments.processes)
+    try:
+        rendered = sum(pool.map(render_group, jobs, chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(os.path.join(arguments.output_dir, 'index.html'), 'w') as index:
+        index.write('<html><body>\n')
+        for group, issues in groups:
+            index.write('<h1>%s (%d issues)</h1>\n' % (group, len(issues)))
+            chart_filename = '%s_%s-%s.png' % (group, to_date_fetch_query(then), to_date_fetch_query(now))
+            for chart in CHARTS:
+                index.write('<img src="%s_%s" alt="%s"/>\n' % (chart, chart_filename, chart))
+        index.write('</body></html>\n')
+    print 'rendered %d charts to %s' % (rendered, arguments.output_dir)
+
+
+def warm(yt, cache, arguments, now, then):
+    # fetch every project at once, the reports of the morning then read the same keys from the cache: batch and
+    # --release_changes runs look up released issues
+    start = time.time()
+    yt.retain_changes = False
+    project_issues = fetch_projects(yt, arguments.projects, (to_date_fetch_query(now), to_date_fetch_query(then)),
+                                    max(arguments.workers, WARM_WORKERS * len(arguments.projects)), arguments.items)
+    for project in arguments.projects:
+        print '%s: %d issues' % (project, len(project_issues[project]))
+    print 'warmed %s (%s - %s) in %.1f seconds, %d of %d projects were cached already' % (
+        cache.path, to_date_fetch_query(then), to_date_fetch_query(now), time.time() - start, cache.hits,
+        len(arguments.projects))
+
+
+def cache_stats(arguments):
+    from youtrack.issue_cache import CacheStats
+    print CacheStats(arguments.cachedir, datetime.timedelta(days=arguments.cacheage))
+
+
+def fetch_projects(yt, projects, history_range, workers=1, items=1000):
+    from youtrack.kanban_metrics import thread_map
+    # workers threads in total: the projects are fetched side by side and share them for their change histories
+    project_workers = max(1, min(workers, len(projects)))
+    history_workers = max(1, workers // project_workers)
+    return dict(zip(projects, thread_map(lambda project: yt.get_cycle_time_issues(project, items,
+                                                                                  history_range=history_range,
+                                                                                  workers=history_workers),
+                                         projects, project_workers)))
+
+
+def export(yt, projects, history_range, arguments):
+    from youtrack.export import export_issues
+    if not os.path.isdir(arguments.export_dir):
+        os.makedirs(arguments.export_dir)
+    yt.retain_changes = False
+    issues = chain.from_iterable(yt.iter_cycle_time_issues(project, arguments.items, history_range=history_range)
+                                 for project in projects)
+    exported, filenames = export_issues(issues, arguments.export_dir, arguments.export_format)
+    print 'exported %d issues to %s' % (exported, ', '.join(sorted(filenames.values())))
+
+
+def aging(yt, projects, issues, now, items=1000, workers=1):
+    from youtrack.flow import aging_wip
+    from youtrack.kanban_metrics import thread_map
+    from youtrack.quantiles import cycle_time_digest
+    # the threads are shared between the projects and the histories within one, like fetch_projects
+    project_workers = max(1, min(workers, len(projects)))
+    history_workers = max(1, workers // project_workers)
+    aging_issues = [issue for project_issues in thread_map(
+        lambda project: yt.get_aging_issues(project, items, workers=history_workers), projects, project_workers)
+        for issue in project_issues]
+    print 'number of issues in progress: %d' % len(aging_issues)
+    for aging_issue in aging_wip(aging_issues, cycle_time_digest(issues), now):
+        print aging_issue
+
+
+def forecast(issues, now, then, arguments):
+    from youtrack.forecast import MonteCarloForecast, daily_throughput
+    monte_carlo = MonteCarloForecast(daily_throughput(issues, then, now), arguments.trials, arguments.processes)
+    start = now.date()
+    until = None
+    if arguments.forecast_date:
+        until = datetime.datetime.strptime(arguments.forecast_date, '%Y-%m-%d').date()
+    elif not arguments.forecast_items:
+        until = start + datetime.timedelta(days=14)
+    if until:
+        for confidence, items in monte_carlo.items_forecast((until - start).days):
+            print '%d%% confidence: at least %d items done by %s' % (confidence, items, until)
+    if arguments.forecast_items:
+        for confidence, days in monte_carlo.days_forecast(arguments.forecast_items):
+            print '%d%% confidence: %d items done by %s (%d days)' % (
+                confidence, arguments.forecast_items, start + datetime.timedelta(days=days), days)
+
+
+def parse_windows(windows, history_age):
+    # FROM[:AGE] like --history_from and --history_age, returned as (now, then)
+    parsed = []
+    for window in windows:
+        history_from, _, age = window.partition(':')
+        now = datetime.datetime.strptime(history_from, '%Y-%m-%d')
+        parsed.append((now, now - datetime.timedelta(days=int(age) if age else history_age)))
+    return parsed
+
+
+def compare(yt, arguments, windows):
+    from youtrack.summary import WindowComparison
+    # fetch the union of all windows once and slice it by resolved date
+    now = max(window_now for window_now, window_then in windows)
+    then = min(window_then for window_now, window_then in windows)
+    project_issues = fetch_projects(yt, arguments.projects, (to_date_fetch_query(now), to_date_fetch_query(then)),
+                                    arguments.workers, arguments.items)
+    comparison = WindowComparison([issue for project in arguments.projects for issue in project_issues[project]],
+                                  windows)
+    print arguments.projects
+    print comparison
+
+    chart_file = None
+    if arguments.save_chart:
+        chart_file = '%s_%s-%s.png' % (arguments.projects, to_date_fetch_query(then), to_date_fetch_query(now))
+    percentile_comparison(comparison, '%s' % arguments.projects, chart_file, arguments.chart_log)
 
 
 def states(issues, chart_title, chart_file):
+    import numpy
+
     class TimedeltaCounter(Counter):
         def __missing__(self, key):
             return datetime.timedelta(0)
@@ -87,8 +297,14 @@ def states(issues, chart_title, chart_file):
     ax.set_ylabel('Cumulated Cycle Times [days]')
     ax.set_title('Workflow Step chart for  %s' % chart_title)
 
+    show_or_save(plt, 'states', chart_file)
+
+
+def show_or_save(plt, chart_type, chart_file):
     if chart_file:
-        plt.savefig('states_%s' % chart_file)
+        directory, filename = os.path.split(chart_file)
+        plt.savefig(os.path.join(directory, '%s_%s' % (chart_type, filename)))
+        plt.close()
     else:
         plt.show()
 
@@ -116,14 +332,14 @@ def autolabel(rects, labels, ax):
                 label, color='lightgreen', ha='center', va='bottom')
 
 
-def percentile(issues, chart_title, chart_file):
+def percentile(issues, chart_title, chart_file, chart_log=False):
     import matplotlib.pyplot as plt
-    if args.chart_log:
+    from youtrack.quantiles import PERCENTILES, cycle_time_digest
+    if chart_log:
         plt.yscale('log')
 
-    cycletimes = [issue.cycle_time.days for issue in issues]
-    x_axis = (10, 25, 50, 75, 80, 90, 95, 99)
-    y_axis = [numpy.percentile(cycletimes, quantile) for quantile in x_axis]
+    x_axis = PERCENTILES
+    y_axis = cycle_time_digest(issues).percentiles(x_axis)
 
     plt.plot(x_axis, y_axis)
 
@@ -133,15 +349,33 @@ def percentile(issues, chart_title, chart_file):
     plt.grid(True)
     plt.grid(True, which='minor')
 
-    if chart_file:
-        plt.savefig('percentile_%s' % chart_file)
-    else:
-        plt.show()
+    show_or_save(plt, 'percentile', chart_file)
 
 
-def control_chart(issues, chart_title, chart_file):
+def percentile_comparison(comparison, chart_title, chart_file, chart_log=False):
     import matplotlib.pyplot as plt
-    if args.chart_log:
+    if chart_log:
+        plt.yscale('log')
+
+    for (now, then), percentiles in zip(comparison.windows, comparison.percentiles):
+        if percentiles is not None:
+            plt.plot(comparison.quantiles, percentiles, label='%s - %s' % (then.date(), now.date()))
+
+    plt.xlabel('Percentile')
+    plt.ylabel('Cycle Time [days]')
+    plt.title('Percentile comparison for  %s' % chart_title)
+    plt.legend(loc='upper left')
+    plt.grid(True)
+    plt.grid(True, which='minor')
+
+    show_or_save(plt, 'compare', chart_file)
+
+
+def control_chart(issues, chart_title, chart_file, chart_log=False, point_budget=None):
+    import matplotlib.pyplot as plt
+    from youtrack.downsample import downsample_issues
+    issues = downsample_issues(issues, point_budget)
+    if chart_log:
         plt.yscale('log')
     axis = plt.subplot()
     x_resolved_date = [issue.resolved_date.toordinal() for issue in issues]
@@ -158,17 +392,46 @@ def control_chart(issues, chart_title, chart_file):
     plt.grid(True)
     plt.grid(True, which='minor')
 
-    if chart_file:
-        plt.savefig('control_%s' % chart_file)
-    else:
-        plt.show()
+    show_or_save(plt, 'control', chart_file)
 
 
-def histogram(issues, chart_title, chart_file):
+def wip(flow, chart_title, chart_file):
     import matplotlib.pyplot as plt
+    dates = flow.dates
+    plt.step(dates, flow.wip, where='post', color='blue', label='WiP')
+    plt.bar(dates, flow.arrivals, color='green', alpha=0.5, label='Arrivals')
+    plt.bar(dates, -flow.departures, color='red', alpha=0.5, label='Departures')
+    plt.legend(loc='upper left')
+    plt.xticks(rotation=25)
+    plt.xlabel('Date')
+    plt.ylabel('Items')
+    plt.title('Daily WiP for  %s' % chart_title)
+    plt.grid(True)
+
+    show_or_save(plt, 'wip', chart_file)
+
+
+def cfd(flow, chart_title, chart_file):
+    import matplotlib.pyplot as plt
+    dates = flow.dates
+    for state, lower, upper in flow.bands():
+        plt.fill_between(dates, lower, upper, label=state, alpha=0.75)
+    plt.legend(loc='upper left', fontsize='small')
+    plt.xticks(rotation=25)
+    plt.xlabel('Date')
+    plt.ylabel('Items')
+    plt.title('Cumulative Flow Diagram for  %s' % chart_title)
+    plt.grid(True)
+
+    show_or_save(plt, 'cfd', chart_file)
+
+
+def histogram(issues, chart_title, chart_file, chart_log=False):
+    import matplotlib.pyplot as plt
+    import numpy
     cycletimes = [issue.cycle_time.days for issue in issues]
 
-    if args.chart_log:
+    if chart_log:
         plt.xscale('log')
         plt.grid(True, which='minor')
         plot_bins = numpy.logspace(0, math.ceil(numpy.log10(max(cycletimes))), num=10)
@@ -186,61 +449,87 @@ def histogram(issues, chart_title, chart_file):
     plt.title('Cycle Time Histogram for %s' % chart_title)
     plt.ylim([0, max(n) + 1])
     plt.grid(True)
-    if chart_file:
-        plt.savefig('histogram_%s' % chart_file)
-    else:
-        plt.show()
+    show_or_save(plt, 'histogram', chart_file)
 
 
 def base(issues, now, then):
-    timespan = (now - then).days
-    print 'oldest issue  : %s' % min(issues, key=attrgetter('resolved_date'))
-    print 'youngest issue: %s' % max(issues, key=attrgetter('resolved_date'))
-    cycletimes = [issue.cycle_time.days for issue in issues]
-    print 'min issue     : %s' % min(issues, key=attrgetter('cycle_time.days'))
-    print 'median issue  : %s' % sorted(issues, key=attrgetter('cycle_time.days'))[len(issues) // 2]
-    print 'max issue     : %s' % max(issues, key=attrgetter('cycle_time.days'))
-
-    print 'timespan (%s - %s): %d days' % (now, then, timespan)
-    print 'number of finished issues: %d' % len(issues)
-    started_issues = filter(lambda issue: issue.cycle_time_start > then, issues)
-    print 'number of started issues: %d' % len(started_issues)
-
-    mean_cycle_time = numpy.mean(cycletimes)
-    print 'mean cycle time: %d days' % mean_cycle_time
-    print 'mean WiP: %.2f items' % (len(issues) / float(timespan) * mean_cycle_time)
-    print 'pull rate: %.2f issues per week' % (len(started_issues) / float(timespan) * 7)
+    from youtrack.summary import SummaryStatistics
+    summary = SummaryStatistics(issues, now, then)
+    print summary
+    return summary
 
 
 def metrics(issues):
-    cycletimes = [issue.cycle_time.days for issue in issues]
-    issue_to_print = [issue for issue in issues]
-    for quantile in (10, 25, 50, 75, 80, 90, 95, 99):
-        quantile_cycle_time = numpy.percentile(cycletimes, quantile)
-        print '%d%% percentile: %s days' % (quantile, quantile_cycle_time)
-        for issue in issue_to_print:
-            if issue.cycle_time.days <= quantile_cycle_time:
-                print issue
-                issue_to_print.remove(issue)
+    from youtrack.quantiles import percentile_breakdown
+    for bucket in percentile_breakdown(issues):
+        print bucket
+        for issue in bucket.issues:
+            print issue
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('projects', nargs='+', help='the project to calculate statistics for')
+    parser.add_argument('projects', nargs='*', help='the project to calculate statistics for')
     parser.add_argument('-v', '--verbose', dest='verbose', help='print status messages to stdout more verbose',
                         action='count')
-    parser.add_argument('--username', dest='username', required=True, help='username for login')
-    parser.add_argument('--password', dest='password', required=True, help='password for login')
+    parser.add_argument('--url', dest='url', default='https://tickets.i.gini.net', help='youtrack to connect to')
+    parser.add_argument('--username', dest='username', help='username for login')
+    parser.add_argument('--password', dest='password', help='password for login')
+    parser.add_argument('--cachedir', dest='cachedir', default=os.environ.get('KANBAN_CACHE_DIR'),
+                        help='directory to cache fetched issues in (default: $KANBAN_CACHE_DIR, none)')
+    parser.add_argument('--cacheage', dest='cacheage', default=1, type=int, help='days before updating cache')
+    parser.add_argument('--nocache', dest='nocache', action='store_true', default=False,
+                        help="don't use the cache, fetch live data")
     parser.add_argument('-a', '--history_age', dest='history_age', default=90, type=int,
                         help='how many days to fetch (from now)')
     parser.add_argument('--history_from', dest='history_from', help='where to start fetching (instead of "now")')
     parser.add_argument('-l', '--chart_log', dest='chart_log', action='store_true', default=False,
                         help='create the chart using a log scale')
+    parser.add_argument('-w', '--workers', dest='workers', default=1, type=int,
+                        help='threads fetching projects and their change histories concurrently, in total')
+    parser.add_argument('--items', dest='items', default=1000, type=int,
+                        help='maximum number of issues to fetch per project')
+    parser.add_argument('--export_dir', dest='export_dir', default='.', help='directory to export to')
+    parser.add_argument('--export_format', dest='export_format', default='auto', choices=('auto', 'parquet', 'csv'),
+                        help='parquet when pyarrow is installed (auto) or csv')
+    parser.add_argument('--history_store', dest='history_store',
+                        help='file to keep change histories in, only issues updated since are fetched again')
+    parser.add_argument('--release_changes', dest='release_changes', action='store_true', default=False,
+                        help='drop the raw change history of each issue once its metrics are calculated')
+    parser.add_argument('--forecast_date', dest='forecast_date',
+                        help='forecast how many items are done by this date (default: in 14 days)')
+    parser.add_argument('--forecast_items', dest='forecast_items', type=int,
+                        help='forecast when this number of items is done')
+    parser.add_argument('--trials', dest='trials', default=10000, type=int, help='number of forecast simulations')
+    parser.add_argument('--processes', dest='processes', type=int,
+                        help='processes to spread forecast simulations or batch rendering over')
+    parser.add_argument('--output_dir', dest='output_dir', default='charts',
+                        help='directory to render all charts to in batch mode')
+    parser.add_argument('--point_budget', dest='point_budget', type=int,
+                        help='draw at most this many issues in the control chart, thinned keeping its shape')
+    parser.add_argument('--window', dest='windows', action='append', metavar='FROM[:AGE]',
+                        help='window to compare, repeat for more, all are fetched at once '
+                             '(default: --history_from and --history_age)')
     parser.add_argument('--save_chart', dest='save_chart', action='store_true', default=None,
                         help='save chart to file instead of showing it')
 
-    parser.add_argument('chart', choices=('histogram', 'control', 'metrics', 'basic', 'percentile', 'states'),
+    parser.add_argument('chart', choices=('histogram', 'control', 'metrics', 'basic', 'percentile', 'states', 'wip',
+                                          'cfd', 'forecast', 'aging', 'export', 'batch', 'compare', 'warm',
+                                          'cache-stats'),
                         help='metric to calculate')
 
     args = parser.parse_args()
+    if args.chart in ('warm', 'cache-stats') and not args.cachedir:
+        parser.error('%s needs --cachedir' % args.chart)
+    if args.cacheage < 1:
+        parser.error('--cacheage has to be at least one day, --nocache bypasses the cache')
+    if args.chart == 'warm' and args.nocache:
+        parser.error('warm fills the cache, --nocache makes no sense')
+    if args.point_budget and args.point_budget < 3:
+        parser.error('--point_budget needs at least 3 points, the first, the last and one in between')
+    if args.chart != 'cache-stats':
+        if not args.projects:
+            parser.error('at least one project is required')
+        if not args.username or not args.password:
+            parser.error('--username and --password are required')
     main(args)
@@ -1,20 +1,53 @@
 #!/usr/bin/env python
 # coding=UTF-8
 
+import argparse
 import datetime
+import json
 import logging
 import os
+import csv
+import shutil
+import subprocess
 import sys
+import StringIO
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 from functools import partial
+from multiprocessing import Pool, active_children
+from multiprocessing.pool import ThreadPool
 
 import numpy
 import pyfscache
 
+from fake_youtrack import FakeYouTrack
+from main import fetch_projects, batch, warm, aging
 from youtrack import IssueChange, ChangeField, Issue
-from youtrack.connection import Connection
+from youtrack.connection import Connection, UPSTREAM_REQUESTS
 from youtrack.kanban_metrics import YoutrackProvider, ChangesProvider, CycleTimeAwareIssue, has_state_changes, \
-    has_new_value, KanbanAwareYouTrackConnection, millis_to_datetime
+    has_new_value, KanbanAwareYouTrackConnection, millis_to_datetime, StateChange, HistoryStore, FETCH_SECONDS
+from youtrack.quantiles import TDigest, PERCENTILES, merge_digests, percentile_breakdown, cycle_time_digest
+from youtrack.downsample import lttb_indices, downsample_issues
+from youtrack.export import export_issues
+from youtrack.instrumentation import Registry
+from youtrack.issue_cache import IssueCache, CacheStats
+from youtrack.flow import daily_flow, cumulative_flow, aging_wip
+from youtrack.forecast import MonteCarloForecast, daily_throughput
+from youtrack.refresh import BackgroundRefresher
+from youtrack.rollups import RollupStore, day_key
+from youtrack.sessions import ConnectionRegistry
+from youtrack.shared_cache import SharedCache, LeaseTimeout
+from youtrack.singleflight import SingleFlight, SUPPRESSED_CALLS
+from youtrack.summary import SummaryStatistics, WindowComparison
+
+try:
+    import web
+except ImportError:
+    # the web app needs flask, flask-login and bokeh
+    web = None
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
@@ -100,6 +133,20 @@ class TestCalculateCycleTime(unittest.TestCase):
                          '(Open->In Progress): 2013-03-11 01:07:51.944000, '
                          '(In Progress->Complete): 2016-09-03 02:11:11.944000, cycle time: 1272 days, 1:03:20')
 
+    def test_release_changes(self):
+        issue = Issue()
+        issue.created = '123'
+        issue.id = 'BACKEND-671'
+        retained_issue = CycleTimeAwareIssue(issue, TestProvider())
+        released_issue = CycleTimeAwareIssue(issue, TestProvider(), retain_changes=False)
+
+        self.assertEqual((), released_issue.changes)
+        self.assertIsNone(released_issue.history_provider)
+        self.assertEqual(retained_issue.cycle_time, released_issue.cycle_time)
+        self.assertEqual(retained_issue.resolved_date, released_issue.resolved_date)
+        self.assertEqual(retained_issue.time_in_state('Open'), released_issue.time_in_state('Open'))
+        self.assertLess(released_issue.memory_size(), retained_issue.memory_size())
+
     def test_cycle_time_from_issue_changes(self):
         changes = init_changes()
 
@@ -180,3 +227,1141 @@ class TestCalculateCycleTime(unittest.TestCase):
         self.assertEqual(13, complete_state_datetime.day)
 
         self.assertEqual(datetime.timedelta(7, 3875, 903000), complete_state_datetime - open_state_datetime)
+
+
+class CycleTimeIssue(object):
+    def __init__(self, issue_id, days):
+        self.issue_id = issue_id
+        self.cycle_time = datetime.timedelta(days=days)
+
+
+class TestPercentileBreakdown(unittest.TestCase):
+    def test_issues_are_assigned_to_first_matching_percentile(self):
+        issues = [CycleTimeIssue('ISSUE-%d' % days, days) for days in (5, 1, 3, 100, 2, 2, 8, 4, 6, 7)]
+        buckets = percentile_breakdown(issues)
+
+        self.assertEqual(list(PERCENTILES), [bucket.quantile for bucket in buckets])
+        self.assertEqual(numpy.percentile([5, 1, 3, 100, 2, 2, 8, 4, 6, 7], 50), buckets[2].cycle_time)
+        assigned = [issue for bucket in buckets for issue in bucket.issues]
+        self.assertEqual(len(set(assigned)), len(assigned))
+        for bucket in buckets:
+            for issue in bucket.issues:
+                self.assertLessEqual(issue.cycle_time.days, bucket.cycle_time)
+        self.assertEqual(['ISSUE-1'], [issue.issue_id for issue in buckets[0].issues])
+        self.assertEqual(['ISSUE-2', 'ISSUE-2'], [issue.issue_id for issue in buckets[1].issues])
+        self.assertNotIn('ISSUE-100', [issue.issue_id for issue in assigned])
+
+    def test_empty(self):
+        self.assertEqual([], percentile_breakdown([]))
+
+
+class TestTDigest(unittest.TestCase):
+    def test_small_digest_matches_numpy(self):
+        values = [3, 1, 4, 1, 5, 9, 2, 6, 5, 3, 5, 8, 9, 7, 9]
+        digest = TDigest.from_values(values)
+        for quantile in PERCENTILES:
+            self.assertAlmostEqual(numpy.percentile(values, quantile), digest.percentile(quantile))
+
+    def test_large_digest_is_bounded_and_accurate(self):
+        values = numpy.random.RandomState(42).exponential(20, 20000)
+        digest = TDigest.from_values(values)
+        self.assertEqual(20000, len(digest))
+        self.assertLess(len(digest.centroids()), 500)
+        for quantile in PERCENTILES:
+            expected = numpy.percentile(values, quantile)
+            self.assertAlmostEqual(expected, digest.percentile(quantile), delta=expected * 0.02)
+
+    def test_merge(self):
+        values = numpy.random.RandomState(7).exponential(20, 10000)
+        merged = merge_digests([TDigest.from_values(values[:3000]), TDigest.from_values(values[3000:])])
+        self.assertEqual(10000, merged.count)
+        self.assertEqual(min(values), merged.min)
+        self.assertEqual(max(values), merged.max)
+        for quantile in PERCENTILES:
+            expected = numpy.percentile(values, quantile)
+            self.assertAlmostEqual(expected, merged.percentile(quantile), delta=expected * 0.02)
+
+
+class FlowIssue(object):
+    def __init__(self, issue_id, cycle_time_start, cycle_time_end):
+        self.issue_id = issue_id
+        self.cycle_time_start = cycle_time_start
+        self.cycle_time_end = self.resolved_date = cycle_time_end
+        self.cycle_time = cycle_time_end - cycle_time_start
+        self.state_changes = []
+
+    def __str__(self):
+        return '[%s]' % self.issue_id
+
+
+def flow_issues():
+    start = datetime.datetime(2016, 9, 1)
+    return [FlowIssue('ISSUE-%d' % number, start + datetime.timedelta(days=started), start + datetime.timedelta(
+        days=resolved)) for number, (started, resolved) in
+            enumerate(((-10, 2), (0, 5), (1, 3), (2, 10), (4, 5), (6, 20), (8, 9)))]
+
+
+class TestSummaryStatistics(unittest.TestCase):
+    def test_summary(self):
+        issues = flow_issues()
+        now = datetime.datetime(2016, 9, 21)
+        then = datetime.datetime(2016, 9, 1)
+        summary = SummaryStatistics(issues, now, then)
+
+        self.assertEqual('ISSUE-0', summary.oldest_issue.issue_id)
+        self.assertEqual('ISSUE-5', summary.youngest_issue.issue_id)
+        self.assertEqual(1, summary.min_issue.cycle_time.days)
+        self.assertEqual(14, summary.max_issue.cycle_time.days)
+        self.assertEqual(sorted(issue.cycle_time.days for issue in issues)[len(issues) // 2],
+                         summary.median_issue.cycle_time.days)
+        self.assertEqual(20, summary.timespan)
+        self.assertEqual(7, summary.finished)
+        self.assertEqual(5, summary.started)
+        self.assertAlmostEqual(numpy.mean([issue.cycle_time.days for issue in issues]), summary.mean_cycle_time)
+        self.assertAlmostEqual(5 / 20.0 * 7, summary.pull_rate)
+        self.assertAlmostEqual(summary.flow.wip.mean(), summary.mean_wip)
+        self.assertEqual(12, len(summary.lines()))
+
+    def test_window_comparison(self):
+        issues = flow_issues()
+        windows = [(datetime.datetime(2016, 9, 6), datetime.datetime(2016, 9, 1)),
+                   (datetime.datetime(2016, 9, 21), datetime.datetime(2016, 9, 10)),
+                   (datetime.datetime(2016, 1, 10), datetime.datetime(2016, 1, 1))]
+        comparison = WindowComparison(issues, windows)
+
+        self.assertEqual([['ISSUE-0', 'ISSUE-2', 'ISSUE-1', 'ISSUE-4'], ['ISSUE-6', 'ISSUE-3', 'ISSUE-5'], []],
+                         [[issue.issue_id for issue in window_issues] for window_issues in comparison.issues])
+        self.assertEqual(4, comparison.summaries[0].finished)
+        self.assertEqual(3, comparison.summaries[1].finished)
+        self.assertIsNone(comparison.summaries[2])
+        self.assertEqual(list(cycle_time_digest(comparison.issues[1]).percentiles(PERCENTILES)),
+                         list(comparison.percentiles[1]))
+        self.assertEqual(1 + 8 + len(PERCENTILES), len(comparison.lines()))
+
+
+class TestDailyFlow(unittest.TestCase):
+    def test_daily_flow(self):
+        issues = flow_issues()
+        flow = daily_flow(issues, datetime.datetime(2016, 9, 1), datetime.datetime(2016, 9, 11))
+
+        self.assertEqual(11, len(flow.wip))
+        self.assertEqual(datetime.date(2016, 9, 1), flow.dates[0])
+        self.assertEqual(datetime.date(2016, 9, 11), flow.dates[-1])
+        for offset, date in enumerate(flow.dates):
+            in_progress = [issue for issue in issues if
+                           issue.cycle_time_start.date() <= date < issue.cycle_time_end.date()]
+            self.assertEqual(len(in_progress), flow.wip[offset], date)
+        self.assertEqual([1, 1, 1, 0, 1, 0, 1, 0, 1, 0, 0], list(flow.arrivals))
+        self.assertEqual([0, 0, 1, 1, 0, 2, 0, 0, 0, 1, 1], list(flow.departures))
+        self.assertEqual(3, flow.max_wip)
+
+
+def workflow_issue(issue_id, created, *transitions):
+    issue = FlowIssue(issue_id, created, created)
+    last_updated = created
+    for from_state, to_state, updated in transitions:
+        issue.state_changes.append(StateChange(from_state, to_state, updated, updated - last_updated))
+        last_updated = updated
+    return issue
+
+
+class TestCumulativeFlow(unittest.TestCase):
+    def test_cumulative_flow(self):
+        issues = [workflow_issue('ISSUE-1', datetime.datetime(2016, 9, 1, 10),
+                                 ('Open', 'In Progress', datetime.datetime(2016, 9, 2, 10)),
+                                 ('In Progress', 'Done', datetime.datetime(2016, 9, 4, 10))),
+                  workflow_issue('ISSUE-2', datetime.datetime(2016, 9, 2, 10),
+                                 ('Open', 'In Progress', datetime.datetime(2016, 9, 3, 10)),
+                                 ('In Progress', 'Done', datetime.datetime(2016, 9, 6, 10)))]
+        flow = cumulative_flow(issues, datetime.datetime(2016, 9, 1), datetime.datetime(2016, 9, 7))
+
+        self.assertEqual(['Open', 'In Progress', 'Done'], flow.states)
+        self.assertEqual(7, len(flow.dates))
+        self.assertEqual([1, 1, 0, 0, 0, 0, 0], list(flow.in_state[:, 0]))
+        self.assertEqual([0, 1, 2, 1, 1, 0, 0], list(flow.in_state[:, 1]))
+        self.assertEqual([0, 0, 0, 1, 1, 2, 2], list(flow.in_state[:, 2]))
+        self.assertEqual([1, 2, 2, 2, 2, 2, 2], list(flow.arrivals[:, 0]))
+        self.assertEqual(['Done', 'In Progress', 'Open'], [state for state, lower, upper in flow.bands()])
+        self.assertEqual([1, 2, 2, 2, 2, 2, 2], list(list(flow.bands())[-1][2]))
+
+
+class TestMonteCarloForecast(unittest.TestCase):
+    def test_daily_throughput(self):
+        throughput = daily_throughput(flow_issues(), datetime.datetime(2016, 9, 1), datetime.datetime(2016, 9, 11))
+        self.assertEqual([0, 0, 1, 1, 0, 2, 0, 0, 0, 1, 1], list(throughput))
+
+    def test_constant_throughput_is_deterministic(self):
+        monte_carlo = MonteCarloForecast([2, 2, 2], trials=1000, seed=1)
+        self.assertEqual([(50, 20), (85, 20), (95, 20)], monte_carlo.items_forecast(10))
+        self.assertEqual([(50, 5), (85, 5), (95, 5)], monte_carlo.days_forecast(9))
+
+    def test_forecast_bounds(self):
+        monte_carlo = MonteCarloForecast([0, 1, 3, 0, 2], trials=25000, seed=3, chunk_size=10000)
+        items = monte_carlo.items_by(20)
+        self.assertEqual(25000, len(items))
+        self.assertTrue(0 <= items.min() and items.max() <= 60)
+        self.assertAlmostEqual(24, items.mean(), delta=0.5)
+        days = monte_carlo.days_until(30)
+        self.assertTrue(days.min() >= 10)
+        self.assertAlmostEqual(25, numpy.median(days), delta=2)
+
+    def test_pool_is_shut_down(self):
+        forecast = MonteCarloForecast([0, 1, 2, 3], trials=400, processes=2, seed=7, chunk_size=100)
+        self.assertEqual(400, len(forecast.items_by(10)))
+        self.assertRaises(TypeError, forecast.items_by, 'ten days')
+        self.assertEqual([], active_children())
+
+    def test_no_throughput(self):
+        self.assertRaises(ValueError, MonteCarloForecast, [0, 0])
+
+
+class TestKanbanAwareYouTrackConnection(unittest.TestCase):
+    def setUp(self):
+        self.fake_youtrack = FakeYouTrack(('BACKEND', 'MOBILE'), 12, end=datetime.datetime(2016, 9, 30)).start()
+
+    def tearDown(self):
+        self.fake_youtrack.stop()
+
+    def test_parallel_fetch_matches_sequential(self):
+        sequential = KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'user', 'password')
+        parallel = KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'user', 'password', workers=4)
+
+        expected = [str(issue) for issue in sequential.get_cycle_time_issues('BACKEND', 1000)]
+        self.assertEqual(12, len(expected))
+        self.assertEqual(expected, [str(issue) for issue in parallel.get_cycle_time_issues('BACKEND', 1000)])
+        self.assertEqual(expected, [str(issue) for issue in
+                                    parallel.iter_cycle_time_issues('BACKEND', 1000, batch_size=5)])
+
+        project_issues = fetch_projects(parallel, ('BACKEND', 'MOBILE'), None, 2)
+        self.assertEqual(expected, [str(issue) for issue in project_issues['BACKEND']])
+        self.assertEqual(12, len(project_issues['MOBILE']))
+
+    def test_fetch_projects_shares_the_workers(self):
+        calls = []
+
+        class RecordingConnection(object):
+            def get_cycle_time_issues(self, project, items, history_range=None, workers=None):
+                calls.append(workers)
+                return [project]
+
+        for workers, projects, history_workers in ((1, ('A', 'B', 'C'), 1), (4, ('A', 'B', 'C'), 1),
+                                                   (8, ('A', 'B', 'C'), 2), (8, ('A',), 8)):
+            del calls[:]
+            self.assertEqual(dict((project, [project]) for project in projects),
+                             fetch_projects(RecordingConnection(), projects, None, workers))
+            self.assertEqual([history_workers] * len(projects), calls)
+            self.assertLessEqual(min(workers, len(projects)) * history_workers, workers)
+
+    def test_positional_connection_arguments(self):
+        # cache, then proxy_info: the options of this class are keyword only
+        yt = KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'user', 'password', None, None, workers=3)
+        self.assertIsNone(yt._proxy_info)
+        self.assertEqual((True, 3, None), (yt.retain_changes, yt.workers, yt.history_store))
+
+
+class TestAgingWip(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime.datetime(2016, 9, 30)
+        self.fake_youtrack = FakeYouTrack(('BACKEND',), 20, end=self.now, open_issues_per_project=3).start()
+        self.store_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.fake_youtrack.stop()
+        shutil.rmtree(self.store_directory)
+
+    def test_aging_issues_compared_to_finished_issues(self):
+        yt = KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'user', 'password')
+        finished_issues = yt.get_cycle_time_issues('BACKEND', 1000)
+        aging_issues = aging_wip(yt.get_aging_issues('BACKEND', 1000), cycle_time_digest(finished_issues), self.now)
+
+        self.assertEqual(['BACKEND-22', 'BACKEND-21', 'BACKEND-20'],
+                         [aging_issue.issue.issue_id for aging_issue in aging_issues])
+        self.assertEqual([23, 22, 21], [aging_issue.age.days for aging_issue in aging_issues])
+        self.assertEqual('In Progress', aging_issues[0].issue.current_state)
+        self.assertEqual(99, aging_issues[0].percentile)
+        self.assertIn('older than 99% of finished issues', str(aging_issues[0]))
+
+    def test_aging_report(self):
+        yt = KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'user', 'password', workers=4)
+        finished_issues = yt.get_cycle_time_issues('BACKEND', 1000)
+        output = StringIO.StringIO()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            aging(yt, ['BACKEND'], finished_issues, self.now, items=2, workers=4)
+        finally:
+            sys.stdout = stdout
+        lines = output.getvalue().splitlines()
+        # the items of the command line and its history_from
+        self.assertEqual('number of issues in progress: 2', lines[0])
+        self.assertEqual(2, len(lines[1:]))
+        self.assertIn('[BACKEND-21] in [In Progress] for 22 days', lines[1])
+
+    def test_only_updated_histories_are_fetched_again(self):
+        filename = os.path.join(self.store_directory, 'histories')
+        history_store = HistoryStore(filename)
+        yt = KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'user', 'password', history_store=history_store)
+        aging_issues = yt.get_aging_issues('BACKEND', 1000)
+        self.assertEqual(3, len(aging_issues))
+        self.assertEqual(3, self.fake_youtrack.history_requests)
+        history_store.close()
+        # storing the histories leaves the fetched changes connected
+        self.assertIs(yt, aging_issues[0].changes[0].youtrack)
+        self.assertIs(yt, aging_issues[0].changes[0].fields[0].youtrack)
+
+        self.fake_youtrack.issues['BACKEND-21'].move(self.now - datetime.timedelta(days=1), 'In Progress', 'Review')
+        history_store = HistoryStore(filename)
+        yt = KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'user', 'password', history_store=history_store)
+        aging_issues = dict((issue.issue_id, issue) for issue in yt.get_aging_issues('BACKEND', 1000))
+        history_store.close()
+
+        self.assertEqual(4, self.fake_youtrack.history_requests)
+        self.assertEqual((2, 1), (history_store.hits, history_store.misses))
+        self.assertEqual('Review', aging_issues['BACKEND-21'].current_state)
+        self.assertEqual('In Progress', aging_issues['BACKEND-20'].current_state)
+
+
+class TestRollups(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime.datetime(2016, 9, 30)
+        self.fake_youtrack = FakeYouTrack(('BACKEND', 'MOBILE'), 30, end=self.now).start()
+        self.yt = KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'user', 'password')
+
+    def tearDown(self):
+        self.fake_youtrack.stop()
+
+    def test_range_from_daily_rollups(self):
+        then = self.now - datetime.timedelta(days=60)
+        rollups = RollupStore()
+        for project in ('BACKEND', 'MOBILE'):
+            rollups.refresh(self.yt, project, then, self.now)
+        self.assertEqual(60, self.fake_youtrack.history_requests)
+
+        issues = self.yt.get_cycle_time_issues('BACKEND', 1000) + self.yt.get_cycle_time_issues('MOBILE', 1000)
+        range_rollup = rollups.range(('BACKEND', 'MOBILE'), then, self.now)
+        self.assertEqual(60, range_rollup.count)
+        self.assertEqual(sum((issue.cycle_time for issue in issues), datetime.timedelta()) / 60,
+                         range_rollup.mean_cycle_time)
+        self.assertEqual(zip(PERCENTILES, cycle_time_digest(issues).percentiles()), range_rollup.percentiles())
+
+        first_day, last_day = datetime.date(2016, 9, 20), datetime.date(2016, 9, 25)
+        in_range = [issue for issue in issues if first_day <= issue.resolved_date.date() <= last_day]
+        self.assertEqual(len(in_range), rollups.range(('BACKEND', 'MOBILE'), first_day, last_day).count)
+        self.assertEqual(0, rollups.range(('BACKEND',), then, then).count)
+
+    def test_ranges_are_fetched_completely(self):
+        then = self.now - datetime.timedelta(days=60)
+        rollups = RollupStore()
+        rollups.refresh(self.yt, 'BACKEND', then, self.now, items=7)
+        self.assertEqual(30, rollups.range(('BACKEND',), then, self.now).count)
+
+    def test_slow_project_does_not_block_others(self):
+        then = self.now - datetime.timedelta(days=60)
+        release = threading.Event()
+        yt = self.yt
+
+        class SlowBackend(object):
+            def iter_cycle_time_issues(self, project, items, history_range=None, batch_size=100):
+                if project == 'BACKEND':
+                    release.wait()
+                return yt.iter_cycle_time_issues(project, items, history_range, batch_size)
+
+        rollups = RollupStore()
+        backend = threading.Thread(target=rollups.refresh, args=(SlowBackend(), 'BACKEND', then, self.now))
+        backend.start()
+        try:
+            rollups.refresh(SlowBackend(), 'MOBILE', then, self.now)
+            self.assertEqual(30, rollups.range(('BACKEND', 'MOBILE'), then, self.now).count)
+        finally:
+            release.set()
+            backend.join()
+        self.assertEqual(60, rollups.range(('BACKEND', 'MOBILE'), then, self.now).count)
+
+    def test_shared_rollups(self):
+        directory = tempfile.mkdtemp()
+        try:
+            then = self.now - datetime.timedelta(days=60)
+            RollupStore(SharedCache(os.path.join(directory, 'shared.sqlite'))).refresh(self.yt, 'BACKEND', then,
+                                                                                        self.now)
+            self.assertEqual(30, self.fake_youtrack.history_requests)
+            shared = SharedCache(os.path.join(directory, 'shared.sqlite'))
+            days = set(issue.resolved.date() for issue in self.fake_youtrack.projects['BACKEND'])
+            stored = shared.get_many(day_key('rollups  BACKEND', day) for day in days)
+            # the fetched range and a rollup per day
+            self.assertEqual(len(days), len(stored))
+            self.assertEqual(len(days) + 1, len(shared))
+
+            other_worker = RollupStore(SharedCache(os.path.join(directory, 'shared.sqlite')))
+            other_worker.refresh(self.yt, 'BACKEND', then, self.now)
+            # only the last day, it may not have been over yet
+            resolved_on_last_day = len([issue for issue in self.fake_youtrack.projects['BACKEND']
+                                        if issue.resolved.date() == self.now.date()])
+            self.assertEqual(30 + resolved_on_last_day, self.fake_youtrack.history_requests)
+            self.assertEqual(30, other_worker.range(('BACKEND',), then, self.now).count)
+            # nothing new was resolved, no day was written again
+            self.assertEqual(dict((key, result.computed) for key, result in stored.items()),
+                             dict((key, result.computed) for key, result in shared.get_many(stored).items()))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_waiting_for_shared_rollups_times_out(self):
+        directory = tempfile.mkdtemp()
+        try:
+            then = self.now - datetime.timedelta(days=60)
+            filename = os.path.join(directory, 'shared.sqlite')
+            RollupStore(SharedCache(filename)).refresh(self.yt, 'BACKEND', then, self.now)
+            fetched = self.fake_youtrack.history_requests
+            held = threading.Event()
+            release = threading.Event()
+
+            def fetching_worker():
+                with SharedCache(filename).lock('rollups  BACKEND'):
+                    held.set()
+                    release.wait()
+
+            thread = threading.Thread(target=fetching_worker)
+            thread.start()
+            try:
+                held.wait()
+                waiting = RollupStore(SharedCache(filename), wait=datetime.timedelta(seconds=0.2))
+                waiting.refresh(self.yt, 'BACKEND', then, self.now)
+                # served from what the other worker stored, without fetching
+                self.assertEqual(fetched, self.fake_youtrack.history_requests)
+                self.assertEqual(30, waiting.range(('BACKEND',), then, self.now).count)
+            finally:
+                release.set()
+                thread.join()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_gaps_are_fetched_only(self):
+        fetched = []
+        yt = self.yt
+
+        class Spy(object):
+            def iter_cycle_time_issues(self, project, items, history_range=None, batch_size=100):
+                fetched.append(history_range)
+                return yt.iter_cycle_time_issues(project, items, history_range, batch_size)
+
+        rollups = RollupStore()
+        rollups.refresh(Spy(), 'BACKEND', datetime.date(2016, 7, 1), datetime.date(2016, 7, 10))
+        rollups.refresh(Spy(), 'BACKEND', datetime.date(2016, 9, 1), datetime.date(2016, 9, 30))
+        rollups.refresh(Spy(), 'BACKEND', datetime.date(2016, 7, 5), datetime.date(2016, 9, 30))
+        # the day between the two windows and the last day, which may not have been over
+        self.assertEqual([('2016-07-10', '2016-07-01'), ('2016-09-30', '2016-09-01'), ('2016-08-31', '2016-07-11'),
+                          ('2016-09-30', '2016-09-30')], fetched)
+        self.assertEqual(30, rollups.range(('BACKEND',), datetime.date(2016, 7, 1), self.now).count)
+
+    def test_refresh_fetches_missing_days_only(self):
+        rollups = RollupStore()
+        rollups.refresh(self.yt, 'BACKEND', datetime.datetime(2016, 9, 20), datetime.datetime(2016, 9, 25))
+        fetched = self.fake_youtrack.history_requests
+        self.assertEqual(fetched, rollups.range(('BACKEND',), self.now - datetime.timedelta(days=60), self.now).count)
+
+        rollups.refresh(self.yt, 'BACKEND', datetime.datetime(2016, 9, 20), datetime.datetime(2016, 9, 25))
+        resolved_on_last_day = len([issue for issue in self.fake_youtrack.projects['BACKEND']
+                                    if issue.resolved.date() == datetime.date(2016, 9, 25)])
+        self.assertEqual(fetched + resolved_on_last_day, self.fake_youtrack.history_requests)
+
+        rollups.refresh(self.yt, 'BACKEND', self.now - datetime.timedelta(days=60), self.now)
+        self.assertEqual(30, rollups.range(('BACKEND',), self.now - datetime.timedelta(days=60), self.now).count)
+
+
+class TestBackgroundRefresher(unittest.TestCase):
+    def test_serves_last_result_while_refreshing(self):
+        computed = []
+        failing = []
+
+        def compute(key):
+            if failing:
+                raise IOError('youtrack unavailable')
+            computed.append(key)
+            return '%s %d' % (key, len(computed))
+
+        refresher = BackgroundRefresher(compute, datetime.timedelta(minutes=5))
+        self.assertIsNone(refresher.get('BACKEND'))
+        self.assertEqual('BACKEND 1', refresher.refresh('BACKEND').value)
+        self.assertEqual('BACKEND 1', refresher.get('BACKEND').value)
+        self.assertEqual(1, len(computed))
+
+        stale = datetime.datetime.now() + datetime.timedelta(minutes=10)
+        self.assertEqual('BACKEND 1', refresher.get('BACKEND', stale).value)
+        while refresher.is_refreshing('BACKEND'):
+            time.sleep(0.01)
+        self.assertEqual('BACKEND 2', refresher.get('BACKEND').value)
+
+        failing.append(True)
+        logging.disable(logging.ERROR)
+        try:
+            self.assertEqual('BACKEND 2', refresher.refresh('BACKEND').value)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertFalse(refresher.is_refreshing('BACKEND'))
+
+        refresher.store('MOBILE', 'streamed')
+        self.assertEqual('streamed', refresher.get('MOBILE').value)
+        self.assertNotIn('MOBILE', computed)
+
+    def test_evicts_keys_nobody_asks_for(self):
+        refresher = BackgroundRefresher(lambda key: key.lower(), datetime.timedelta(minutes=5),
+                                        datetime.timedelta(minutes=30), max_keys=2)
+        refresher.start(['BACKEND'], datetime.timedelta(days=1))
+        try:
+            for key in ('BACKEND', 'MOBILE', 'GP', 'MSDK'):
+                refresher.refresh(key)
+            # beyond max_keys the least recently requested window goes, the scheduled ones stay
+            self.assertEqual(['backend', 'gp', 'msdk'], sorted(result.value for result in refresher.results()))
+
+            now = datetime.datetime.now()
+            refresher.get('MSDK', now + datetime.timedelta(minutes=20))
+            self.assertEqual(1, refresher.evict_idle(now + datetime.timedelta(minutes=35)))
+            self.assertEqual(['backend', 'msdk'], sorted(result.value for result in refresher.results()))
+            self.assertEqual(1, refresher.evict_idle(now + datetime.timedelta(hours=1)))
+            self.assertEqual(1, len(refresher))
+        finally:
+            refresher.stop()
+
+
+class TestConnectionRegistry(unittest.TestCase):
+    def test_sessions_share_connections_until_idle(self):
+        logins = []
+
+        def connect(username, password):
+            logins.append(username)
+            return object()
+
+        now = datetime.datetime(2016, 9, 30, 12)
+        registry = ConnectionRegistry(connect, datetime.timedelta(minutes=30))
+        first = registry.login('alice', 'secret', now)
+        second = registry.login('alice', 'secret', now)
+        other = registry.login('bob', 'secret', now)
+        self.assertNotEqual(first, second)
+        self.assertEqual(['alice', 'bob'], logins)
+        self.assertIs(registry.get(first, now), registry.get(second, now))
+        self.assertIsNot(registry.get(first, now), registry.get(other, now))
+        self.assertIsNone(registry.get('unknown', now))
+
+        registry.login('alice', 'wrong', now)
+        self.assertEqual(['alice', 'bob', 'alice'], logins)
+
+        later = now + datetime.timedelta(minutes=20)
+        self.assertIsNotNone(registry.get(first, later))
+        self.assertEqual(2, registry.evict_idle(later + datetime.timedelta(minutes=20)))
+        self.assertIsNotNone(registry.get(second, later + datetime.timedelta(minutes=20)))
+        self.assertIsNone(registry.get(other, later + datetime.timedelta(minutes=20)))
+
+        registry.logout(first)
+        self.assertIsNotNone(registry.get(second, later + datetime.timedelta(minutes=20)))
+        registry.logout(second)
+        self.assertEqual(0, len(registry))
+
+    def test_connection_for_login(self):
+        now = datetime.datetime(2016, 9, 30, 12)
+        registry = ConnectionRegistry(lambda username, password: (username, password))
+        registry.login('alice', 'old', now)
+        registry.login('alice', 'new', now + datetime.timedelta(minutes=1))
+        self.assertEqual(('alice', 'new'), registry.for_login('alice'))
+        self.assertIsNone(registry.for_login('bob'))
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_calls_share_one_computation(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        computed = []
+
+        def compute(project):
+            computed.append(project)
+            release.wait()
+            if project == 'BROKEN':
+                raise IOError('youtrack unavailable')
+            return [project]
+
+        def call(key):
+            try:
+                return flights.do(key, compute, key[1])
+            except IOError as e:
+                return e
+
+        pool = ThreadPool(6)
+        try:
+            results = pool.map_async(call, [('issues', 'BACKEND')] * 4 + [('issues', 'BROKEN')] * 2)
+            while flights.suppressed < 4:
+                time.sleep(0.01)
+            release.set()
+            results = results.get()
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(['BACKEND', 'BROKEN'], sorted(computed))
+        self.assertEqual([['BACKEND']] * 4, results[:4])
+        self.assertTrue(all(isinstance(result, IOError) for result in results[4:]))
+
+        # nothing is kept once the flight has landed
+        self.assertEqual(['MOBILE'], flights.do(('issues', 'BACKEND'), lambda: ['MOBILE']))
+
+    def test_identical_dashboards_fetch_once_per_user(self):
+        fake_youtrack = FakeYouTrack(('MOBILE',), 10, latency=0.05, end=datetime.datetime(2016, 9, 30)).start()
+        pool = ThreadPool(5)
+        try:
+            suppressed_before = SUPPRESSED_CALLS.value('get_cycle_time_issues')
+            connections = [KanbanAwareYouTrackConnection(fake_youtrack.url, user, 'password')
+                           for user in ('alice', 'alice', 'alice', 'alice', 'bob')]
+            results = pool.map(lambda yt: yt.get_cycle_time_issues('MOBILE', 1000), connections)
+            # bob does not get the issues fetched with alice's permissions
+            self.assertEqual(20, fake_youtrack.history_requests)
+            self.assertEqual(3, SUPPRESSED_CALLS.value('get_cycle_time_issues') - suppressed_before)
+            self.assertEqual(1, len(set(tuple(str(issue) for issue in issues) for issues in results)))
+            self.assertIsNot(results[0][0], results[4][0])
+        finally:
+            pool.close()
+            pool.join()
+            fake_youtrack.stop()
+
+
+class TestDownsample(unittest.TestCase):
+    def test_lttb_keeps_shape_and_outliers(self):
+        x = numpy.arange(10000)
+        y = numpy.sin(x / 500.0)
+        y[5000] = 100
+        y[7777] = -100
+        indices = lttb_indices(x, y, 500)
+
+        self.assertEqual(500, len(indices))
+        self.assertEqual([0, 9999], [indices[0], indices[-1]])
+        self.assertTrue(numpy.all(numpy.diff(indices) > 0))
+        self.assertIn(5000, indices)
+        self.assertIn(7777, indices)
+        self.assertAlmostEqual(1, y[indices][y[indices] < 100].max(), places=3)
+        self.assertEqual(range(100), list(lttb_indices(x[:100], y[:100], 500)))
+        self.assertEqual(range(100), list(lttb_indices(x[:100], y[:100], None)))
+        smallest = lttb_indices(x[:100], y[:100], 3)
+        self.assertEqual(3, len(smallest))
+        self.assertEqual([0, 99], [smallest[0], smallest[-1]])
+        for threshold in (-1, 0, 1, 2):
+            self.assertRaises(ValueError, lttb_indices, x, y, threshold)
+
+    def test_downsample_issues(self):
+        issues = flow_issues()
+        self.assertEqual(sorted(issue.issue_id for issue in issues),
+                         sorted(issue.issue_id for issue in downsample_issues(issues, None)))
+        downsampled = downsample_issues(issues, 4)
+        self.assertEqual(4, len(downsampled))
+        self.assertEqual(['ISSUE-0', 'ISSUE-5'], [downsampled[0].issue_id, downsampled[-1].issue_id])
+        self.assertEqual(sorted(downsampled, key=lambda issue: issue.resolved_date), downsampled)
+        self.assertEqual(7, len(downsample_issues(issues, 0)))
+        self.assertRaises(ValueError, downsample_issues, issues, 2)
+
+
+class TestInstrumentation(unittest.TestCase):
+    def test_exposition(self):
+        registry = Registry()
+        requests = registry.counter('requests_total', 'Requests', ('endpoint', 'status'))
+        seconds = registry.histogram('request_seconds', 'Request duration', ('endpoint',), buckets=(0.1, 1))
+        registry.gauge('cached_issues', 'Cached issues', lambda: 42)
+        requests.inc('/issue/{issue}', 200)
+        requests.inc('/issue/{issue}', 200)
+        requests.inc('/say "hi"', 500)
+        seconds.observe(0.05, '/issue/{issue}')
+        seconds.observe(0.5, '/issue/{issue}')
+        seconds.observe(5, '/issue/{issue}')
+
+        self.assertEqual(['# HELP cached_issues Cached issues',
+                          '# TYPE cached_issues gauge',
+                          'cached_issues 42.0',
+                          '# HELP request_seconds Request duration',
+                          '# TYPE request_seconds histogram',
+                          'request_seconds_bucket{endpoint="/issue/{issue}",le="0.1"} 1',
+                          'request_seconds_bucket{endpoint="/issue/{issue}",le="1.0"} 2',
+                          'request_seconds_bucket{endpoint="/issue/{issue}",le="+Inf"} 3',
+                          'request_seconds_sum{endpoint="/issue/{issue}"} 5.55',
+                          'request_seconds_count{endpoint="/issue/{issue}"} 3',
+                          '# HELP requests_total Requests',
+                          '# TYPE requests_total counter',
+                          'requests_total{endpoint="/issue/{issue}",status="200"} 2.0',
+                          'requests_total{endpoint="/say \\"hi\\"",status="500"} 1.0'],
+                         registry.exposition().splitlines())
+
+    def test_connection_instrumentation(self):
+        fake_youtrack = FakeYouTrack(('BACKEND',), 10, end=datetime.datetime(2016, 9, 30)).start()
+        try:
+            changes_before = UPSTREAM_REQUESTS.value('GET', '/issue/{issue}/changes', 200)
+            fetches_before = FETCH_SECONDS.count('cycle_time')
+            yt = KanbanAwareYouTrackConnection(fake_youtrack.url, 'user', 'password')
+            yt.get_cycle_time_issues('BACKEND', 1000)
+            self.assertEqual(10, UPSTREAM_REQUESTS.value('GET', '/issue/{issue}/changes', 200) - changes_before)
+            self.assertEqual(1, FETCH_SECONDS.count('cycle_time') - fetches_before)
+        finally:
+            fake_youtrack.stop()
+
+
+def compute_shared(filename):
+    def compute():
+        with open(filename + '.computed', 'a') as computed:
+            computed.write('%d\n' % os.getpid())
+        time.sleep(0.3)
+        return {'computed by': os.getpid()}
+
+    return SharedCache(filename, poll_interval=0.01).get_or_compute('issues', compute,
+                                                                    datetime.timedelta(hours=1)).value
+
+
+class TestSharedCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'shared.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_get(self):
+        cache = SharedCache(self.filename)
+        self.assertIsNone(cache.get('BACKEND'))
+        cache.put('BACKEND', [1, 2, 3])
+        cache.put('BACKEND', {'issues': [4]})
+        self.assertEqual({'issues': [4]}, SharedCache(self.filename).get('BACKEND').value)
+        self.assertEqual(1, len(cache))
+        self.assertEqual({'issues': [4]}, cache.get_or_compute('BACKEND', lambda: self.fail('computed'),
+                                                               datetime.timedelta(minutes=5)).value)
+        self.assertEqual('fresh', cache.get_or_compute('BACKEND', lambda: 'fresh', datetime.timedelta(0)).value)
+
+    def test_held_lease_is_renewed(self):
+        cache = SharedCache(self.filename, lease=datetime.timedelta(seconds=0.3), poll_interval=0.01)
+        attempts = []
+
+        def other_worker():
+            try:
+                with cache.lock('BACKEND', datetime.timedelta(seconds=0.1)):
+                    attempts.append('acquired')
+            except LeaseTimeout:
+                attempts.append('timed out')
+
+        with cache.lock('BACKEND'):
+            # held for longer than the lease, the other worker neither takes it over nor waits forever
+            time.sleep(1)
+            thread = threading.Thread(target=other_worker)
+            thread.start()
+            thread.join()
+        self.assertEqual(['timed out'], attempts)
+        thread = threading.Thread(target=other_worker)
+        thread.start()
+        thread.join()
+        self.assertEqual(['timed out', 'acquired'], attempts)
+
+    def test_entries_expire(self):
+        cache = SharedCache(self.filename, lease=datetime.timedelta(seconds=0.1),
+                            lifetime=datetime.timedelta(seconds=1))
+        cache.put_many([('BACKEND', 1), ('SEMANTIC', 2)])
+        with cache.lock('MOBILE'):
+            pass
+        self.assertTrue(cache.try_acquire('GP'))
+        time.sleep(0.6)
+        cache.put_many([('MOBILE', 3)], touch=['BACKEND'])
+        time.sleep(0.6)
+        cache.put('GP', 4)
+        self.assertIsNone(cache.get('SEMANTIC'))
+        self.assertEqual(1, cache.get('BACKEND').value)
+        self.assertEqual(3, len(cache))
+        self.assertEqual([], cache._database().execute('SELECT key FROM leases').fetchall())
+
+    def test_one_process_computes(self):
+        pool = Pool(3)
+        try:
+            results = pool.map(compute_shared, [self.filename] * 3)
+        finally:
+            pool.close()
+            pool.join()
+        with open(self.filename + '.computed') as computed:
+            self.assertEqual(1, len(computed.readlines()))
+        self.assertEqual(1, len(set(result['computed by'] for result in results)))
+
+
+class TestIssueCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fake_youtrack = FakeYouTrack(('BACKEND',), 10, end=datetime.datetime(2016, 9, 30)).start()
+
+    def tearDown(self):
+        self.fake_youtrack.stop()
+        shutil.rmtree(self.directory)
+
+    def test_warm_cache_serves_later_runs(self):
+        warm = IssueCache(self.directory, 1)
+        yt = KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'user', 'password', cache=warm)
+        expected = [str(issue) for issue in yt.get_cycle_time_issues('BACKEND', 1000)]
+        self.assertEqual(10, self.fake_youtrack.history_requests)
+        warm.record_run('warm', datetime.datetime(2016, 9, 30, 6))
+
+        report = IssueCache(self.directory, 1)
+        yt = KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'user', 'password', cache=report)
+        self.assertEqual(expected, [str(issue) for issue in yt.get_cycle_time_issues('BACKEND', 1000)])
+        self.assertEqual(10, self.fake_youtrack.history_requests)
+        report.record_run('control', datetime.datetime(2016, 9, 30, 9))
+
+        stats = CacheStats(self.directory, datetime.timedelta(days=1))
+        self.assertEqual(1, stats.entries)
+        self.assertEqual(0, stats.expired)
+        self.assertEqual([1, 0, 0, 0, 0], stats.ages)
+        self.assertEqual([('warm', 0, 1), ('control', 1, 0)],
+                         [(run['command'], run['hits'], run['misses']) for run in stats.runs])
+        self.assertEqual(['  2016-09-30 06:00 warm       hits    0 misses    1 hit rate   0.0%',
+                          '  2016-09-30 09:00 control    hits    1 misses    0 hit rate 100.0%'], stats.lines()[-2:])
+
+        tomorrow = datetime.datetime.now() + datetime.timedelta(days=2)
+        self.assertEqual(1, CacheStats(self.directory, datetime.timedelta(days=1), tomorrow).expired)
+
+    def test_entries_are_kept_per_user_without_secrets(self):
+        cache = IssueCache(self.directory, 1)
+        alice = KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'alice', 's3cretpw', cache=cache)
+        bob = KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'bob', 'hunter2', cache=cache)
+        alice.get_cycle_time_issues('BACKEND', 1000)
+        bob.get_cycle_time_issues('BACKEND', 1000)
+        alice.get_cycle_time_issues('BACKEND', 1000)
+        self.assertEqual(20, self.fake_youtrack.history_requests)
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+        self.assertEqual(2, CacheStats(self.directory, datetime.timedelta(days=1)).entries)
+        for name in os.listdir(self.directory):
+            with open(os.path.join(self.directory, name), 'rb') as entry:
+                content = entry.read()
+            for secret in ('s3cretpw', 'hunter2', 'YTSESSION'):
+                self.assertNotIn(secret, content)
+
+    def test_issues_are_cached_with_a_history_store(self):
+        history_directory = tempfile.mkdtemp()
+        history_store = HistoryStore(os.path.join(history_directory, 'histories'))
+        try:
+            cache = IssueCache(self.directory, 1)
+            yt = KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'user', 'password', cache=cache,
+                                               history_store=history_store)
+            expected = [str(issue) for issue in yt.get_cycle_time_issues('BACKEND', 1000)]
+            self.assertEqual(expected, [str(issue) for issue in yt.get_cycle_time_issues('BACKEND', 1000)])
+            self.assertEqual((1, 1), (cache.hits, cache.misses))
+            self.assertEqual(10, self.fake_youtrack.history_requests)
+        finally:
+            history_store.close()
+            shutil.rmtree(history_directory)
+
+    def test_warm_cache_serves_batch(self):
+        now = datetime.datetime(2016, 9, 30)
+        then = now - datetime.timedelta(days=90)
+        arguments = argparse.Namespace(projects=['BACKEND'], workers=1, items=1000, processes=1,
+                                       output_dir=os.path.join(self.directory, 'charts'), chart_log=False,
+                                       point_budget=None)
+        warm_cache = IssueCache(self.directory, 1)
+        warm(KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'user', 'password', cache=warm_cache),
+             warm_cache, arguments, now, then)
+        batch_cache = IssueCache(self.directory, 1)
+        batch(KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'user', 'password', cache=batch_cache),
+              arguments, now, then)
+        self.assertEqual((1, 0), (batch_cache.hits, batch_cache.misses))
+        self.assertEqual(10, self.fake_youtrack.history_requests)
+
+    def test_missing_cache_is_empty(self):
+        stats = CacheStats(os.path.join(self.directory, 'missing'), datetime.timedelta(days=1))
+        self.assertEqual((0, []), (stats.entries, stats.runs))
+        self.assertIn('(missing)', stats.lines()[0])
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime.datetime(2016, 9, 30)
+        self.fake_youtrack = FakeYouTrack(('BACKEND', 'MOBILE'), 10, end=self.now).start()
+        self.yt = KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'user', 'password')
+        self.output_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.fake_youtrack.stop()
+        shutil.rmtree(self.output_directory)
+
+    def batch(self, now, then):
+        batch(self.yt, argparse.Namespace(projects=['BACKEND', 'MOBILE'], workers=2, items=1000, processes=2,
+                                          output_dir=self.output_directory, chart_log=False, point_budget=None),
+              now, then)
+        return sorted(name for name in os.listdir(self.output_directory) if name.endswith('.png'))
+
+    def test_all_charts_of_all_groups(self):
+        charts = self.batch(self.now, self.now - datetime.timedelta(days=90))
+        self.assertEqual(3 * 6, len(charts))
+        self.assertIn('cfd_BACKEND_MOBILE_2016-07-02-2016-09-30.png', charts)
+
+    def test_empty_window_renders_nothing(self):
+        self.assertEqual([], self.batch(datetime.datetime(2000, 1, 31), datetime.datetime(2000, 1, 1)))
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.fake_youtrack = FakeYouTrack(('BACKEND',), 25, end=datetime.datetime(2016, 9, 30)).start()
+        self.export_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.fake_youtrack.stop()
+        shutil.rmtree(self.export_directory)
+
+    def test_issues_are_closed_when_transitions_cannot_be_written(self):
+        os.mkdir(os.path.join(self.export_directory, 'transitions.csv'))
+        try:
+            export_issues([], self.export_directory, 'csv')
+            self.fail('exported into a directory')
+        except IOError:
+            # still inside the handler, a leaked writer would be alive and its header not flushed
+            with open(os.path.join(self.export_directory, 'issues.csv')) as issues_file:
+                self.assertTrue(issues_file.read().startswith('project,issue_id'))
+
+    def test_csv_export_from_issue_iterator(self):
+        yt = KanbanAwareYouTrackConnection(self.fake_youtrack.url, 'user', 'password', retain_changes=False)
+        exported, filenames = export_issues(yt.iter_cycle_time_issues('BACKEND', 1000, batch_size=10),
+                                            self.export_directory, 'csv', chunk_size=7)
+        self.assertEqual(25, exported)
+
+        with open(filenames['issues'], 'rb') as issues_file:
+            issue_rows = list(csv.DictReader(issues_file))
+        self.assertEqual(25, len(issue_rows))
+        self.assertEqual('BACKEND', issue_rows[0]['project'])
+        self.assertEqual('BACKEND-0', issue_rows[0]['issue_id'])
+        self.assertAlmostEqual(1.0, float(issue_rows[0]['cycle_time_days']))
+        self.assertEqual('Open->In Progress', issue_rows[0]['cycle_time_start_source_transition'])
+
+        with open(filenames['transitions'], 'rb') as transitions_file:
+            transition_rows = list(csv.DictReader(transitions_file))
+        self.assertEqual(50, len(transition_rows))
+        self.assertEqual(('In Progress', 'Complete'), (transition_rows[1]['from_state'], transition_rows[1]['to_state']))
+
+
+@unittest.skipIf(web is None, 'flask, flask-login or bokeh is not installed')
+class TestWeb(unittest.TestCase):
+    def setUp(self):
+        self.fake_youtrack = FakeYouTrack(('BACKEND', 'SEMANTIC', 'MOBILE', 'GP', 'MSDK'), 12,
+                                          end=datetime.datetime.now()).start()
+        web.YOUTRACK_URL = self.fake_youtrack.url
+        web.app.secret_key = 'test'
+        # every test starts from empty caches
+        web.issue_sets = BackgroundRefresher(web.refresh_issues, web.MAX_AGE, web.IDLE_TIMEOUT, web.MAX_WINDOWS)
+        web.dashboards = BackgroundRefresher(web.refresh_dashboard, web.MAX_AGE, web.IDLE_TIMEOUT, web.MAX_WINDOWS)
+        web.connections = ConnectionRegistry(web.connect, web.IDLE_TIMEOUT)
+        web.rollup_stores.clear()
+        self.client = web.app.test_client()
+        self.client.post('/login', data={'username': 'user', 'password': 'password'})
+
+    def tearDown(self):
+        web.dashboards.stop()
+        self.fake_youtrack.stop()
+
+    def test_forecast_without_throughput(self):
+        long_ago = datetime.date.today() - datetime.timedelta(days=3 * 365)
+        response = self.client.get('/forecast?project=backend&history_to=%s&items=10' % long_ago)
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(200, self.client.get('/forecast?project=backend&items=10').status_code)
+
+    def test_startup_does_not_load_numpy(self):
+        loaded = subprocess.check_output([sys.executable, '-c', 'import sys, web; print "numpy" in sys.modules'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual('False', loaded.strip())
+
+    def test_dashboards_are_fetched_per_user(self):
+        other = web.app.test_client()
+        other.post('/login', data={'username': 'bob', 'password': 'password'})
+        self.assertEqual(200, self.client.get('/api/backend/summary').status_code)
+        self.assertIsNotNone(web.issue_sets.get(('user', 'backend', 30, None)))
+        self.assertIsNone(web.issue_sets.get(('bob', 'backend', 30, None)))
+
+        # bob's login does not stand in for a user who logged out
+        self.client.get('/logout')
+        self.assertRaises(RuntimeError, web.refresh_issues, ('user', 'backend', 30, None))
+        self.assertEqual(200, other.get('/api/backend/summary').status_code)
+        self.assertIsNotNone(web.issue_sets.get(('bob', 'backend', 30, None)))
+
+    def test_service_account_fetches_for_everybody(self):
+        web.SERVICE_USER, web.SERVICE_PASSWORD = 'service', 'password'
+        try:
+            self.assertEqual(200, self.client.get('/api/backend/summary').status_code)
+            self.assertIsNotNone(web.issue_sets.get(('service', 'backend', 30, None)))
+            self.assertIsNone(web.issue_sets.get(('user', 'backend', 30, None)))
+            self.assertEqual('service', web.service_connection().identity[1])
+        finally:
+            web.SERVICE_USER = web.SERVICE_PASSWORD = web.service = None
+
+    def test_api_etag(self):
+        response = self.client.get('/api/backend/summary')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(12, json.loads(response.data)['finished'])
+        self.assertIn('Accept-Encoding', response.vary)
+        etag = response.get_etag()[0]
+
+        unchanged = self.client.get('/api/backend/summary', headers={'If-None-Match': '"%s"' % etag})
+        self.assertEqual(304, unchanged.status_code)
+        self.assertEqual('', unchanged.data)
+        self.assertEqual(etag, unchanged.get_etag()[0])
+        self.assertIn('Accept-Encoding', unchanged.vary)
+        self.assertEqual(200, self.client.get('/api/backend/summary', headers={'If-None-Match': '"other"'}).status_code)
+        self.assertEqual(404, self.client.get('/api/unknown/summary').status_code)
+
+    def test_api_gzip(self):
+        plain = self.client.get('/api/backend/control')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        size = len(plain.data)
+
+        old_size = web.GZIP_MIN_SIZE
+        try:
+            web.GZIP_MIN_SIZE = size
+            compressed = self.client.get('/api/backend/control', headers={'Accept-Encoding': 'gzip, deflate'})
+            self.assertEqual('gzip', compressed.headers['Content-Encoding'])
+            self.assertEqual(plain.data, zlib.decompress(compressed.data, 16 + zlib.MAX_WBITS))
+            etag = compressed.get_etag()[0]
+            self.assertEqual(plain.get_etag()[0] + '-gzip', etag)
+            # each representation only matches its own ETag
+            self.assertEqual(304, self.client.get('/api/backend/control', headers={
+                'Accept-Encoding': 'gzip', 'If-None-Match': '"%s"' % etag}).status_code)
+            self.assertEqual(200, self.client.get('/api/backend/control', headers={
+                'If-None-Match': '"%s"' % etag}).status_code)
+            self.assertEqual(200, self.client.get('/api/backend/control', headers={
+                'Accept-Encoding': 'gzip', 'If-None-Match': '"%s"' % plain.get_etag()[0]}).status_code)
+
+            # just below the cut-off the body is sent as it is
+            web.GZIP_MIN_SIZE = size + 1
+            small = self.client.get('/api/backend/control', headers={'Accept-Encoding': 'gzip'})
+            self.assertNotIn('Content-Encoding', small.headers)
+            self.assertEqual(plain.data, small.data)
+        finally:
+            web.GZIP_MIN_SIZE = old_size
+
+    def test_forecast_arguments_are_validated(self):
+        for arguments in ('trials=abc', 'trials=0', 'trials=1000000', 'items=x', 'items=0', 'items=1000000',
+                          'date=tomorrow', 'date=2200-01-01', 'date=2000-01-01', 'history_days=ten'):
+            self.assertEqual(400, self.client.get('/forecast?project=backend&' + arguments).status_code)
+        self.assertEqual(404, self.client.get('/forecast?project=unknown').status_code)
+
+        # the issues come from the cached issue set of the window
+        self.assertEqual(200, self.client.get('/api/backend/summary').status_code)
+        requests = self.fake_youtrack.requests
+        date = (datetime.date.today() + datetime.timedelta(days=30)).strftime('%Y-%m-%d')
+        response = self.client.get('/forecast?project=backend&items=10&trials=1000&date=' + date)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(requests, self.fake_youtrack.requests)
+        forecast = json.loads(response.data)
+        self.assertEqual(10, forecast['days_until_items']['items'])
+        self.assertEqual([50, 85, 95], [entry['confidence'] for entry in forecast['items_by_date']['forecast']])
+
+    def test_forecast_etag_is_stable(self):
+        first = self.client.get('/forecast?project=backend&items=10&trials=1000')
+        self.assertEqual(200, first.status_code)
+        second = self.client.get('/forecast?project=backend&items=10&trials=1000',
+                                 headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(304, second.status_code)
+
+    def test_rendered_components_are_cached_by_data(self):
+        issues, now, then = web.issue_sets.refresh(('user', 'backend', 30, None)).value
+        web.rendered_components.clear()
+        rendered = web.render_components(issues, now, then, SummaryStatistics(issues, now, then))
+        self.assertIs(rendered, web.render_components(issues, now, then, SummaryStatistics(issues, now, then)))
+        self.assertEqual(1, len(web.rendered_components))
+
+        fewer = issues[1:]
+        self.assertIsNot(rendered, web.render_components(fewer, now, then, SummaryStatistics(fewer, now, then)))
+        self.assertEqual(2, len(web.rendered_components))
+
+        old_size = web.COMPONENT_CACHE_SIZE
+        try:
+            web.COMPONENT_CACHE_SIZE = 2
+            web.render_components(issues, now, then, SummaryStatistics(issues, now, then))
+            fewest = issues[2:]
+            web.render_components(fewest, now, then, SummaryStatistics(fewest, now, then))
+            # the least recently used fragments make room
+            self.assertEqual([web.dashboard_fingerprint(data, now, then) for data in (issues, fewest)],
+                             list(web.rendered_components))
+        finally:
+            web.COMPONENT_CACHE_SIZE = old_size
+            web.rendered_components.clear()
+
+    def test_dashboard_loads_bokeh_from_static_route(self):
+        web.dashboards.refresh(('user', 'backend', 30, None))
+        page = self.client.get('/projects?project=backend')
+        self.assertEqual(200, page.status_code)
+        self.assertIn('/bokeh/static/js/bokeh.min.js', page.data)
+
+        bokeh = self.client.get('/bokeh/static/js/bokeh.min.js')
+        self.assertEqual(200, bokeh.status_code)
+        self.assertEqual(web.BOKEH_STATIC_MAX_AGE, bokeh.cache_control.max_age)
+        self.assertIn('Bokeh', bokeh.data)
+        bokeh.close()
+        self.assertEqual(404, self.client.get('/bokeh/static/js/missing.js').status_code)
+
+    def test_control_points_below_minimum(self):
+        self.assertEqual(400, self.client.get('/api/backend/control?points=2').status_code)
+        self.assertEqual(3, len(json.loads(self.client.get('/api/backend/control?points=3').data)['points']))
+
+    def stream_events(self, url):
+        events = []
+        for message in self.client.get(url).data.strip().split('\n\n'):
+            event, data = message.split('\n')
+            events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+        return events
+
+    def test_stream_cold_dashboard(self):
+        old_batch_size = web.STREAM_BATCH_SIZE
+        try:
+            web.STREAM_BATCH_SIZE = 5
+            self.assertIn('EventSource', self.client.get('/projects?project=mobile').data)
+            events = self.stream_events('/projects/stream?project=mobile')
+        finally:
+            web.STREAM_BATCH_SIZE = old_batch_size
+
+        self.assertEqual(('progress', {'fetched': 0, 'projects': 3, 'done': 0}), events[0])
+        self.assertEqual(('done', {'fetched': 36, 'url': '/projects?project=mobile'}), events[-1])
+        self.assertEqual(('progress', {'fetched': 36, 'projects': 3, 'done': 3}), events[-2])
+        partials = [payload for event, payload in events if event == 'partial']
+        self.assertGreaterEqual(len(partials), 36 // 5)
+        self.assertEqual(36, partials[-1]['fetched'])
+        self.assertEqual(36, sum(len(partial['points']) for partial in partials))
+
+        # the streamed result is cached, the dashboard is served without fetching again
+        issues, now, then = web.issue_sets.get(('user', 'mobile', 30, None)).value
+        self.assertEqual(36, len(issues))
+        median = dict(partials[-1]['percentiles'])[50]
+        self.assertAlmostEqual(cycle_time_digest(issues).percentile(50), median, delta=0.5)
+        requests = self.fake_youtrack.requests
+        page = self.client.get('/projects?project=mobile')
+        self.assertIn('/bokeh/static/js/bokeh.min.js', page.data)
+        self.assertEqual(requests, self.fake_youtrack.requests)
+
+    def test_stream_ends_with_failed_event(self):
+        def render_dashboard(issues, now, then):
+            raise RuntimeError('rendering failed')
+
+        old_render_dashboard = web.render_dashboard
+        try:
+            web.render_dashboard = render_dashboard
+            events = self.stream_events('/projects/stream?project=backend')
+        finally:
+            web.render_dashboard = old_render_dashboard
+        self.assertEqual(('failed', {'message': 'rendering failed'}), events[-1])
+
+    def test_stream_stops_fetching_when_client_leaves(self):
+        self.fake_youtrack.latency = 0.02
+        old_batch_size = web.STREAM_BATCH_SIZE
+        try:
+            # issues are fetched in pages, the fetches stop after the page they are in
+            web.STREAM_BATCH_SIZE = 2
+            response = self.client.get('/projects/stream?project=mobile', buffered=False)
+            self.assertTrue(next(iter(response.response)).startswith('event: progress'))
+            response.close()
+        finally:
+            web.STREAM_BATCH_SIZE = old_batch_size
+        for thread in threading.enumerate():
+            if thread.name.startswith('stream '):
+                thread.join(10)
+                self.assertFalse(thread.is_alive())
+        self.assertLess(self.fake_youtrack.history_requests, 36)
+
+    def test_windows_are_validated(self):
+        self.assertEqual(404, self.client.get('/projects?project=unknown').status_code)
+        self.assertEqual(404, self.client.get('/projects/stream?project=unknown').status_code)
+        self.assertEqual(404, self.client.get('/summary?project=unknown').status_code)
+        for window in ('history_days=0', 'history_days=366', 'history_days=ten', 'history_to=yesterday',
+                       'history_to=2001-01-01'):
+            self.assertEqual(400, self.client.get('/projects?project=backend&' + window).status_code)
+            self.assertEqual(400, self.client.get('/api/backend/summary?' + window).status_code)
+
+        day = datetime.date.today() - datetime.timedelta(days=100)
+        self.assertEqual(200, self.client.get('/api/backend/summary?history_to=%d-%d-%d&history_days=7' % (
+            day.year, day.month, day.day)).status_code)
+        self.assertIsNotNone(web.issue_sets.get(('user', 'backend', 7, day.strftime('%Y-%m-%d'))))
@@ -1,14 +1,16 @@
+import _strptime  # strptime imports it lazily, which fails while a refresh thread holds the import lock
 import datetime
+import hashlib
+import Queue
+import json
 import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from operator import attrgetter
 
 import flask
-import numpy
-from bokeh.embed import components
-from bokeh.io import vplot
-from bokeh.layouts import column
-from bokeh.plotting import figure
-from bokeh.resources import INLINE
-from bokeh.util.string import encode_utf8
 from flask import flash
 from flask import render_template
 from flask import session
@@ -16,8 +18,12 @@ from flask import url_for, request
 from flask_login import LoginManager
 from werkzeug.utils import redirect
 
-from main import to_date_fetch_query
+from main import to_date_fetch_query, fetch_projects
+from youtrack.instrumentation import REGISTRY
 from youtrack.kanban_metrics import KanbanAwareYouTrackConnection
+from youtrack.refresh import BackgroundRefresher
+from youtrack.sessions import ConnectionRegistry
+from youtrack.shared_cache import SharedCache
 
 app = flask.Flask(__name__)
 
@@ -27,10 +33,57 @@ project_keys = {
     'mobile': ('MOBILE', 'GP', 'MSDK')
 }
 
-youtrack = {}
-
-
-def control_chart(issues, chart_log=False):
+# dashboards for the default window are refreshed in the background and served from the last good result
+DEFAULT_HISTORY_DAYS = 30
+# every window is a cached issue set and dashboard, windows nobody asked for within IDLE_TIMEOUT are dropped
+MAX_HISTORY_DAYS = 365
+# a forecast simulates trials x days matrices, both are bounded
+MAX_TRIALS = 100000
+MAX_FORECAST_DAYS = 730
+MAX_FORECAST_ITEMS = 10000
+# windows may end at most this long ago, the rollups of a project would otherwise reach back for decades
+MAX_HISTORY_AGE = datetime.timedelta(days=5 * 365)
+MAX_WINDOWS = 32
+REFRESH_INTERVAL = datetime.timedelta(minutes=10)
+MAX_AGE = datetime.timedelta(minutes=5)
+IDLE_TIMEOUT = datetime.timedelta(minutes=30)
+YOUTRACK_URL = os.environ.get('KANBAN_YOUTRACK_URL', 'https://tickets.i.gini.net')
+# dashboards are fetched with the login of the user looking at them, unless a service account is configured: then
+# it fetches every dashboard, everybody who is logged in sees all its issues and the default windows stay fresh
+SERVICE_USER = os.environ.get('KANBAN_SERVICE_USER')
+SERVICE_PASSWORD = os.environ.get('KANBAN_SERVICE_PASSWORD')
+# several worker processes on one host share fetched issue sets and rollups through this SQLite file
+SHARED_CACHE_FILE = os.environ.get('KANBAN_SHARED_CACHE')
+# responses smaller than this are not worth compressing
+GZIP_MIN_SIZE = 512
+# rendered chart fragments are kept per data fingerprint, BokehJS is served as a static asset cached for a year
+COMPONENT_CACHE_SIZE = 64
+# the control chart is thinned to this many glyphs, its shape and outliers are kept
+POINT_BUDGET = 2000
+BOKEH_STATIC_MAX_AGE = 365 * 24 * 60 * 60
+# a cold dashboard streams partial results to the page every this many issues
+STREAM_BATCH_SIZE = 25
+
+shared_cache = SharedCache(SHARED_CACHE_FILE) if SHARED_CACHE_FILE else None
+rollup_stores = {}
+rollup_stores_lock = threading.Lock()
+service = None
+service_lock = threading.Lock()
+rendered_components = OrderedDict()
+rendered_components_lock = threading.Lock()
+
+REQUEST_SECONDS = REGISTRY.histogram('web_request_seconds', 'Duration of requests to the dashboard',
+                                     ('endpoint', 'status'))
+RENDER_SECONDS = REGISTRY.histogram('web_render_seconds', 'Duration of building the bokeh charts of a dashboard')
+RENDERED_COMPONENTS_LOOKUPS = REGISTRY.counter('web_rendered_components_lookups_total',
+                                               'Rendered chart fragments looked up by data fingerprint', ('result',))
+
+
+def control_chart(issues, chart_log=False, point_budget=POINT_BUDGET):
+    # bokeh and numpy are imported on first use, so the app starts serving without paying for them
+    from bokeh.plotting import figure
+    from youtrack.downsample import downsample_issues
+    issues = downsample_issues(issues, point_budget)
     x_resolved_date = [issue.resolved_date for issue in issues]
     y_cycletimes = [issue.cycle_time.days for issue in issues]
 
@@ -46,28 +99,36 @@ def control_chart(issues, chart_log=False):
     return control_chart_figure
 
 
-def histogram_chart(issues, chart_log=False):
+def histogram_bins(issues, chart_log=False):
+    import numpy
     cycletimes = [issue.cycle_time.days for issue in issues]
+    if chart_log:
+        plot_bins = numpy.logspace(0, numpy.math.ceil(numpy.log10(max(cycletimes))), num=10)
+    else:
+        plot_bins = numpy.linspace(0, max(cycletimes), num=10)
+    return numpy.histogram(cycletimes, bins=plot_bins)
+
 
+def histogram_chart(issues, chart_log=False):
+    from bokeh.plotting import figure
     figure_arguments = {'x_axis_label': 'Cycle Time [days]', 'y_axis_label': 'Frequency',
                         'title': 'Cycle Time Histogram'}
 
     if chart_log:
         histogram_figure = figure(x_axis_type='log', **figure_arguments)
-        plot_bins = numpy.logspace(0, numpy.math.ceil(numpy.log10(max(cycletimes))), num=10)
     else:
         histogram_figure = figure(**figure_arguments)
-        plot_bins = numpy.linspace(0, max(cycletimes), num=10)
-    hist, edges = numpy.histogram(cycletimes, bins=plot_bins)
+    hist, edges = histogram_bins(issues, chart_log)
 
-    histogram_figure.quad(top=hist, left=edges[:-1], right=edges[1:])
+    histogram_figure.quad(top=hist, bottom=0, left=edges[:-1], right=edges[1:])
     return histogram_figure
 
 
 def percentile_chart(issues):
-    cycletimes = [issue.cycle_time.days for issue in issues]
-    x_axis = (10, 25, 50, 75, 80, 90, 95, 99)
-    y_axis = [numpy.percentile(cycletimes, quantile) for quantile in x_axis]
+    from bokeh.plotting import figure
+    from youtrack.quantiles import PERCENTILES, cycle_time_digest
+    x_axis = PERCENTILES
+    y_axis = cycle_time_digest(issues).percentiles(x_axis)
 
     histogram_figure = figure(x_axis_label='Percentile', y_axis_label='Cycle Time [days]', title='Percentile chart')
 
@@ -76,6 +137,30 @@ def percentile_chart(issues):
     return histogram_figure
 
 
+def wip_chart(flow):
+    from bokeh.plotting import figure
+    wip_figure = figure(x_axis_label='Date', y_axis_label='Items', x_axis_type='datetime', title='Daily WiP')
+    dates = flow.dates
+    wip_figure.line(dates, flow.wip, legend='WiP')
+    wip_figure.line(dates, flow.arrivals, color='green', legend='Arrivals')
+    wip_figure.line(dates, flow.departures, color='red', legend='Departures')
+
+    return wip_figure
+
+
+def cfd_chart(flow):
+    from bokeh.palettes import Spectral11
+    from bokeh.plotting import figure
+    cfd_figure = figure(x_axis_label='Date', y_axis_label='Items', x_axis_type='datetime',
+                        title='Cumulative Flow Diagram')
+    dates = flow.dates
+    for index, (state, lower, upper) in enumerate(flow.bands()):
+        cfd_figure.patch(dates + dates[::-1], list(upper) + list(lower[::-1]),
+                         color=Spectral11[index % len(Spectral11)], alpha=0.75, legend=state)
+
+    return cfd_figure
+
+
 def getitem(obj, item, default):
     if item not in obj:
         return default
@@ -83,63 +168,531 @@ def getitem(obj, item, default):
         return obj[item]
 
 
+def int_argument(args, name, default, lowest, highest):
+    try:
+        value = int(getitem(args, name, default))
+    except ValueError:
+        flask.abort(400, '%s has to be a whole number' % name)
+    if not lowest <= value <= highest:
+        flask.abort(400, '%s has to be between %d and %d' % (name, lowest, highest))
+    return value
+
+
+def date_argument(args, name):
+    try:
+        return datetime.datetime.strptime(args[name], '%Y-%m-%d')
+    except ValueError:
+        flask.abort(400, '%s has to be a date like 2016-09-30' % name)
+
+
+def window_arguments(args):
+    # history_days and a normalized history_to of the request, anything else than a date and a sane number of days
+    # would add another window to the caches
+    history_days = int_argument(args, 'history_days', DEFAULT_HISTORY_DAYS, 1, MAX_HISTORY_DAYS)
+    history_to = to_date_fetch_query(date_argument(args, 'history_to')) if args.get('history_to') else None
+    if history_to is not None and history_to < to_date_fetch_query(datetime.datetime.now() - MAX_HISTORY_AGE):
+        flask.abort(400, 'history_to may be at most %d days ago' % MAX_HISTORY_AGE.days)
+    return history_days, history_to
+
+
+def history_window(args):
+    history_days, history_to = window_arguments(args)
+    if history_to is not None:
+        now = datetime.datetime.strptime(history_to, '%Y-%m-%d')
+    else:
+        now = datetime.datetime.now()
+    return now, now - datetime.timedelta(days=history_days), history_days
+
+
+def window_key(owner, project, args):
+    # issue sets and dashboards are cached per owner, project group and window, a window without history_to moves
+    return (owner, project) + window_arguments(args)
+
+
+def key_window(key):
+    owner, project, history_days, history_to = key
+    if history_to:
+        now = datetime.datetime.strptime(history_to, '%Y-%m-%d')
+    else:
+        now = datetime.datetime.now()
+    return now, now - datetime.timedelta(days=history_days)
+
+
+def fetch_issues(yt, projects, now, then):
+    # all projects of a group are fetched at once, the caller aggregates and renders them once
+    project_issues = fetch_projects(yt, projects, (to_date_fetch_query(now), to_date_fetch_query(then)),
+                                    len(projects))
+    return [issue for project in projects for issue in project_issues[project]]
+
+
+def dashboard_fingerprint(issues, now, then):
+    # everything the charts are drawn from: the window and every issue with its transitions
+    fingerprint = hashlib.sha1('%s %s' % (to_date_fetch_query(then), to_date_fetch_query(now)))
+    for issue in sorted(issues, key=attrgetter('issue_id')):
+        fingerprint.update('|%s %s %s %s' % (issue.issue_id, issue.cycle_time_start, issue.resolved_date,
+                                             issue.cycle_time))
+        for state_change in issue.state_changes:
+            fingerprint.update(' %s %s' % (state_change.transition, state_change.updated))
+    return fingerprint.hexdigest()
+
+
+def render_components(issues, now, then, summary):
+    from bokeh.embed import components
+    from bokeh.layouts import column
+    from youtrack.flow import cumulative_flow
+    key = dashboard_fingerprint(issues, now, then)
+    with rendered_components_lock:
+        rendered = rendered_components.pop(key, None)
+        if rendered is not None:
+            rendered_components[key] = rendered
+            RENDERED_COMPONENTS_LOOKUPS.inc('hit')
+            return rendered
+    RENDERED_COMPONENTS_LOOKUPS.inc('miss')
+
+    with RENDER_SECONDS.time():
+        control_plot = control_chart(issues)
+        histogram_plot = histogram_chart(issues)
+        percentile_plot = percentile_chart(issues)
+        wip_plot = wip_chart(summary.flow)
+        cfd_plot = cfd_chart(cumulative_flow(issues, then, now))
+        rendered = components(column([control_plot, histogram_plot, percentile_plot, wip_plot, cfd_plot]))
+
+    with rendered_components_lock:
+        rendered_components[key] = rendered
+        while len(rendered_components) > COMPONENT_CACHE_SIZE:
+            rendered_components.popitem(last=False)
+    return rendered
+
+
+def render_dashboard(issues, now, then):
+    from youtrack.quantiles import percentile_breakdown
+    from youtrack.summary import SummaryStatistics
+    summary = SummaryStatistics(issues, now, then)
+    script, div = render_components(issues, now, then, summary)
+    return {'plot_script': script, 'plot_div': div, 'percentiles': percentile_breakdown(issues), 'summary': summary,
+            'history_from': to_date_fetch_query(then), 'history_to': to_date_fetch_query(now)}
+
+
+def refresh_issues(key):
+    now, then = key_window(key)
+    yt = owner_connection(key[0])
+    if yt is None:
+        raise RuntimeError('%s is not logged in' % key[0])
+    if shared_cache is None:
+        return fetch_issues(yt, project_keys[key[1]], now, then), now, then
+    # one worker process fetches, the others read its result
+    return shared_cache.get_or_compute(shared_issues_key(key), lambda: (
+        fetch_issues(yt, project_keys[key[1]], now, then), now, then), MAX_AGE).value
+
+
+def shared_issues_key(key):
+    return 'issues %s %s %d %s' % key
+
+
+def refresh_dashboard(key):
+    result = issue_sets.refresh(key)
+    if result is None:
+        raise RuntimeError('no issues for %s' % (key,))
+    return render_dashboard(*result.value)
+
+
+def window_issues(project, args):
+    # (issues, now, then) of the requested window from the background refreshed issue sets
+    key = window_key(window_owner(), project, args)
+    result = issue_sets.get(key) or issue_sets.refresh(key)
+    if result is None:
+        flask.abort(503)
+    return result.value
+
+
+def control_points(issues):
+    return [{'issue': issue.issue_id, 'resolved_date': issue.resolved_date.isoformat(),
+             'cycle_time': issue.cycle_time.days}
+            for issue in sorted(issues, key=lambda issue: (issue.resolved_date, issue.issue_id))]
+
+
+def sse_event(event, payload):
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(payload, separators=(',', ':')))
+
+
+def stream_issues(yt, key, done_url):
+    # fetch the projects of the group in parallel and send progress and partial results while the issues come in
+    from youtrack.quantiles import PERCENTILES, TDigest
+    fetched = Queue.Queue()
+    # set once the stream is over, also when the client went away, the fetches stop with their next issue
+    stopped = threading.Event()
+
+    def fetch(project):
+        try:
+            for issue in yt.iter_cycle_time_issues(project, 1000, history_range, STREAM_BATCH_SIZE):
+                if stopped.is_set():
+                    return
+                fetched.put((issue, None))
+        except Exception, e:
+            fetched.put((None, '%s: %s' % (project, e)))
+        else:
+            fetched.put((None, None))
+
+    try:
+        now, then = key_window(key)
+        projects = project_keys[key[1]]
+        history_range = (to_date_fetch_query(now), to_date_fetch_query(then))
+        for project in projects:
+            thread = threading.Thread(target=fetch, args=(project,), name='stream %s' % project)
+            thread.daemon = True
+            thread.start()
+
+        issues = []
+        digest = TDigest()
+        sent = 0
+        running = len(projects)
+        yield sse_event('progress', {'fetched': 0, 'projects': len(projects), 'done': 0})
+        while running:
+            issue, error = fetched.get()
+            if error is not None:
+                yield sse_event('failed', {'message': error})
+                return
+            if issue is None:
+                running -= 1
+            else:
+                issues.append(issue)
+                if len(issues) - sent < STREAM_BATCH_SIZE:
+                    continue
+            if len(issues) > sent:
+                digest.update(added.cycle_time.days for added in issues[sent:])
+                yield sse_event('partial', {'fetched': len(issues), 'points': control_points(issues[sent:]),
+                                            'percentiles': zip(PERCENTILES, digest.percentiles())})
+                sent = len(issues)
+            yield sse_event('progress', {'fetched': len(issues), 'projects': len(projects),
+                                         'done': len(projects) - running})
+
+        if not issues:
+            yield sse_event('failed', {'message': 'no finished issues in this window'})
+            return
+        # cache the complete result, done_url is then served without fetching again
+        issue_sets.store(key, (issues, now, then))
+        if shared_cache is not None:
+            shared_cache.put(shared_issues_key(key), (issues, now, then))
+        dashboards.store(key, render_dashboard(issues, now, then))
+        yield sse_event('done', {'fetched': len(issues), 'url': done_url})
+    except Exception, e:
+        # without a last event the page's EventSource would reconnect and fetch everything again
+        app.logger.exception('streaming %s failed', key)
+        yield sse_event('failed', {'message': str(e)})
+    finally:
+        stopped.set()
+
+
+def json_response(payload):
+    # content hash as ETag, so unchanged data costs a 304 without a body; the gzip body is another representation
+    # and gets its own strong ETag
+    body = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    gzipped = len(body) >= GZIP_MIN_SIZE and 'gzip' in request.headers.get('Accept-Encoding', '')
+    etag = hashlib.sha1(body).hexdigest() + ('-gzip' if gzipped else '')
+    if etag in request.if_none_match:
+        response = flask.Response(status=304)
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        return response
+
+    response = flask.Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    if gzipped:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        response.set_data(compressor.compress(body) + compressor.flush())
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def rollup_store(owner):
+    # the rollups keep t-digests, numpy is loaded with the first summary
+    with rollup_stores_lock:
+        if owner not in rollup_stores:
+            from youtrack.rollups import RollupStore
+            rollup_stores[owner] = RollupStore(shared_cache, owner)
+        return rollup_stores[owner]
+
+
+def connect(username, password):
+    return KanbanAwareYouTrackConnection(YOUTRACK_URL, username, password, retain_changes=False)
+
+
+def user_connection():
+    # the connection of this session, None once it was evicted for being idle
+    return connections.get(session.get('token'))
+
+
+def window_owner():
+    # whose login fetches the dashboards of this session
+    return SERVICE_USER or session.get('username')
+
+
+def service_connection():
+    global service
+    with service_lock:
+        if service is None:
+            service = connect(SERVICE_USER, SERVICE_PASSWORD)
+        return service
+
+
+def owner_connection(owner):
+    # a user's dashboards are never fetched with somebody else's login
+    if SERVICE_USER:
+        return service_connection()
+    return connections.for_login(owner)
+
+
+issue_sets = BackgroundRefresher(refresh_issues, MAX_AGE, IDLE_TIMEOUT, MAX_WINDOWS)
+dashboards = BackgroundRefresher(refresh_dashboard, MAX_AGE, IDLE_TIMEOUT, MAX_WINDOWS)
+connections = ConnectionRegistry(connect, IDLE_TIMEOUT)
+
+REGISTRY.gauge('web_cached_issue_sets', 'Issue sets cached per project group and window', lambda: len(issue_sets))
+REGISTRY.gauge('web_cached_issues', 'Issues held in the cached issue sets',
+               lambda: sum(len(result.value[0]) for result in issue_sets.results()))
+REGISTRY.gauge('web_cached_dashboards', 'Dashboards cached per project group and window', lambda: len(dashboards))
+REGISTRY.gauge('web_rendered_components', 'Rendered chart fragments cached by data fingerprint',
+               lambda: len(rendered_components))
+REGISTRY.gauge('web_connections', 'Connections of logged in users', lambda: len(connections))
+if shared_cache is not None:
+    REGISTRY.gauge('web_shared_cache_entries', 'Issue sets and rollups in the shared cache', lambda: len(shared_cache))
+
+
+@app.before_request
+def start_timer():
+    flask.g.request_start = time.time()
+
+
+@app.after_request
+def observe_request(response):
+    # streamed responses are observed when their headers are sent
+    if 'request_start' in flask.g:
+        REQUEST_SECONDS.observe(time.time() - flask.g.request_start, request.endpoint or 'unknown',
+                                response.status_code)
+    return response
+
+
 @app.route('/')
 def index():
-    if not session.get('logged_in'):
+    if not session.get('logged_in') or user_connection() is None:
+        session['logged_in'] = False
         return render_template('login.html')
     return redirect(url_for('projects_metrics'))
 
 
 @app.route('/login', methods=['POST'])
 def login():
-    youtrack['connection'] = KanbanAwareYouTrackConnection('https://tickets.i.gini.net', request.form['username'],
-                                                           request.form['password'])
+    session['token'] = connections.login(request.form['username'], request.form['password'])
+    session['username'] = request.form['username']
+    if SERVICE_USER:
+        dashboards.start([(SERVICE_USER, project, DEFAULT_HISTORY_DAYS, None) for project in sorted(project_keys)],
+                         REFRESH_INTERVAL)
     session['logged_in'] = True
     flash('Logged in [%s] successfully' % request.form['username'])
     return redirect(url_for('projects_metrics'))
 
 
+@app.route('/logout')
+def logout():
+    connections.logout(session.pop('token', None))
+    session.pop('username', None)
+    session['logged_in'] = False
+    return redirect(url_for('index'))
+
+
 @app.route('/projects')
 def projects_metrics():
+    from bokeh.resources import Resources
+    from bokeh.util.string import encode_utf8
     # Grab the inputs arguments from the URL
     args = flask.request.args
 
     # Get all the form arguments in the url with defaults
-    projects = project_keys[getitem(args, 'project', 'mobile')]
-    if 'history_to' in args:
-        now = datetime.datetime.strptime(args['history_to'], '%Y-%m-%d')
-    else:
-        now = datetime.datetime.now()
-    history_days = int(getitem(args, 'history_days', 30))
-    then = now - datetime.timedelta(days=history_days)
+    project = getitem(args, 'project', 'mobile')
+    if project not in project_keys:
+        flask.abort(404)
+    now, then, history_days = history_window(args)
+    if user_connection() is None:
+        return redirect(url_for('index'))
+
+    key = window_key(window_owner(), project, args)
+    result = dashboards.get(key)
+    if result is None:
+        # nothing cached yet: answer at once and stream the issues into the page while they are fetched
+        return render_template('loading.html', project=project, history_from=to_date_fetch_query(then),
+                               history_to=to_date_fetch_query(now), history_days=history_days,
+                               stream_url=url_for('projects_stream', **args.to_dict()))
+    dashboard = result.value
+    computed = result.computed
+
+    # script tags pointing at bokeh_static instead of the inlined megabytes of BokehJS
+    resources = Resources(mode='server', root_url=url_for('index') + 'bokeh/')
+    html = flask.render_template(
+        'single_project.html',
+        js_resources=resources.render_js(),
+        css_resources=resources.render_css(),
+        project=project,
+        history_days=history_days,
+        computed=computed.strftime('%Y-%m-%d %H:%M:%S'),
+        age_minutes=(datetime.datetime.now() - computed).total_seconds() // 60,
+        refreshing=dashboards.is_refreshing(key),
+        **dashboard
+    )
+    return encode_utf8(html)
 
-    issues = []
-    for project in projects:
-        issues.extend(youtrack['connection'].get_cycle_time_issues(project, 1000,
-                                                                   history_range=(
-                                                                       to_date_fetch_query(now),
-                                                                       to_date_fetch_query(then))))
 
-        control_plot = control_chart(issues)
-        histogram_plot = histogram_chart(issues)
-        percentile_plot = percentile_chart(issues)
+@app.route('/projects/stream')
+def projects_stream():
+    args = flask.request.args
+    project = getitem(args, 'project', 'mobile')
+    if project not in project_keys:
+        flask.abort(404)
+    if user_connection() is None:
+        flask.abort(401)
+    key = window_key(window_owner(), project, args)
+    yt = owner_connection(key[0])
+    done_url = url_for('projects_metrics', **args.to_dict())
+    return flask.Response(flask.stream_with_context(stream_issues(yt, key, done_url)), mimetype='text/event-stream',
+                          headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-        js_resources = INLINE.render_js()
-        css_resources = INLINE.render_css()
-
-        script, div = components(column([control_plot, histogram_plot, percentile_plot]))
-        html = flask.render_template(
-            'single_project.html',
-            plot_script=script,
-            plot_div=div,
-            js_resources=js_resources,
-            css_resources=css_resources,
-            project=getitem(args, 'project', 'mobile'),
-            history_from=to_date_fetch_query(then),
-            history_to=to_date_fetch_query(now),
-            history_days=history_days
-        )
-    return encode_utf8(html)
+
+@app.route('/metrics')
+def metrics():
+    return flask.Response(REGISTRY.exposition(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/bokeh/static/<path:filename>')
+def bokeh_static(filename):
+    from bokeh.util.paths import bokehjsdir
+    return flask.send_from_directory(bokehjsdir(), filename, cache_timeout=BOKEH_STATIC_MAX_AGE)
+
+
+@app.route('/forecast')
+def forecast():
+    from youtrack.forecast import MonteCarloForecast, daily_throughput
+    args = flask.request.args
+    project = getitem(args, 'project', 'mobile')
+    if project not in project_keys:
+        flask.abort(404)
+    if user_connection() is None:
+        flask.abort(401)
+    trials = int_argument(args, 'trials', 10000, 1, MAX_TRIALS)
+    items = int_argument(args, 'items', 1, 1, MAX_FORECAST_ITEMS) if 'items' in args else None
+    until = date_argument(args, 'date').date() if 'date' in args else None
+    issues, now, then = window_issues(project, args)
+    start = now.date()
+    if until is not None and not 0 <= (until - start).days <= MAX_FORECAST_DAYS:
+        flask.abort(400, 'date has to be within %d days after history_to' % MAX_FORECAST_DAYS)
+    # seeded by the data, the same issues give the same forecast and so the same ETag
+    seed = int(dashboard_fingerprint(issues, now, then)[:7], 16)
+    try:
+        monte_carlo = MonteCarloForecast(daily_throughput(issues, then, now), trials, seed=seed)
+    except ValueError, e:
+        # nothing was finished in the window, there is nothing to resample
+        flask.abort(400, str(e))
+    if items is not None and items / monte_carlo.throughput.mean() > MAX_FORECAST_DAYS:
+        # the simulated days grow with the items a trial has to reach
+        flask.abort(400, '%d items take longer than %d days at this throughput' % (items, MAX_FORECAST_DAYS))
+
+    result = {'project': project, 'history_from': to_date_fetch_query(then), 'history_to': to_date_fetch_query(now),
+              'trials': trials}
+    if until is not None:
+        result['items_by_date'] = {
+            'date': to_date_fetch_query(until),
+            'forecast': [{'confidence': confidence, 'items': count} for confidence, count in
+                         monte_carlo.items_forecast((until - start).days)]}
+    if items is not None:
+        result['days_until_items'] = {
+            'items': items,
+            'forecast': [{'confidence': confidence, 'days': days,
+                          'date': to_date_fetch_query(start + datetime.timedelta(days=days))} for confidence, days in
+                         monte_carlo.days_forecast(items)]}
+    return json_response(result)
+
+
+@app.route('/summary')
+def summary_metrics():
+    args = flask.request.args
+    if getitem(args, 'project', 'mobile') not in project_keys:
+        flask.abort(404)
+    now, then, history_days = history_window(args)
+    projects = project_keys[getitem(args, 'project', 'mobile')]
+    if user_connection() is None:
+        flask.abort(401)
+    owner = window_owner()
+    yt = owner_connection(owner)
+    store = rollup_store(owner)
+    for project in projects:
+        store.refresh(yt, project, then, now)
+    range_rollup = store.range(projects, then, now)
+
+    mean_cycle_time = range_rollup.mean_cycle_time
+    return json_response({'project': getitem(args, 'project', 'mobile'), 'history_from': to_date_fetch_query(then),
+                          'history_to': to_date_fetch_query(now), 'finished': range_rollup.count,
+                          'days': range_rollup.days,
+                          'mean_cycle_time': mean_cycle_time.total_seconds() / 86400 if mean_cycle_time else None,
+                          'percentiles': [{'percentile': quantile, 'cycle_time': cycle_time} for quantile, cycle_time
+                                          in range_rollup.percentiles()]})
+
+
+def api_issues(project):
+    if project not in project_keys:
+        flask.abort(404)
+    if user_connection() is None:
+        flask.abort(401)
+    args = flask.request.args
+    issues, now, then = window_issues(project, args)
+    return issues, now, then, {'project': project, 'history_from': to_date_fetch_query(then),
+                               'history_to': to_date_fetch_query(now)}
+
+
+@app.route('/api/<project>/summary')
+def api_summary(project):
+    from youtrack.summary import SummaryStatistics
+    issues, now, then, result = api_issues(project)
+    result['finished'] = len(issues)
+    if issues:
+        summary = SummaryStatistics(issues, now, then)
+        result.update({'started': summary.started, 'mean_cycle_time': float(summary.mean_cycle_time),
+                       'min_cycle_time': summary.min_issue.cycle_time.days,
+                       'median_cycle_time': summary.median_issue.cycle_time.days,
+                       'max_cycle_time': summary.max_issue.cycle_time.days, 'mean_wip': float(summary.mean_wip),
+                       'max_wip': int(summary.max_wip), 'pull_rate': summary.pull_rate})
+    return json_response(result)
+
+
+@app.route('/api/<project>/percentiles')
+def api_percentiles(project):
+    from youtrack.quantiles import percentile_breakdown
+    issues, now, then, result = api_issues(project)
+    result['percentiles'] = [{'percentile': bucket.quantile, 'cycle_time': bucket.cycle_time,
+                              'issues': [issue.issue_id for issue in bucket.issues]}
+                             for bucket in percentile_breakdown(issues)] if issues else []
+    return json_response(result)
+
+
+@app.route('/api/<project>/histogram')
+def api_histogram(project):
+    issues, now, then, result = api_issues(project)
+    chart_log = getitem(flask.request.args, 'log', 'false') == 'true'
+    result['bins'] = []
+    if issues:
+        hist, edges = histogram_bins(issues, chart_log)
+        result['bins'] = [{'left': float(left), 'right': float(right), 'count': int(count)}
+                          for left, right, count in zip(edges[:-1], edges[1:], hist)]
+    return json_response(result)
+
+
+@app.route('/api/<project>/control')
+def api_control(project):
+    from youtrack.downsample import downsample_issues
+    issues, now, then, result = api_issues(project)
+    try:
+        points = downsample_issues(issues, int(getitem(flask.request.args, 'points', POINT_BUDGET)))
+    except ValueError, e:
+        flask.abort(400, str(e))
+    result['points'] = control_points(points)
+    return json_response(result)
 
 
 if __name__ == "__main__":
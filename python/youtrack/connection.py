@@ -1,9 +1,11 @@
 import calendar
 import functools
+import hashlib
 import json
 import re
 import sys
 import tempfile
+import threading
 import time
 import urllib
 import urllib2
@@ -14,6 +16,16 @@ from xml.sax.saxutils import escape, quoteattr
 
 import httplib2
 import youtrack
+from youtrack.instrumentation import REGISTRY
+from youtrack.singleflight import FLIGHTS
+
+UPSTREAM_REQUESTS = REGISTRY.counter('youtrack_http_requests_total', 'HTTP calls to YouTrack',
+                                     ('method', 'endpoint', 'status'))
+UPSTREAM_SECONDS = REGISTRY.histogram('youtrack_http_request_seconds', 'Duration of HTTP calls to YouTrack',
+                                      ('method', 'endpoint'))
+ENDPOINT_PATTERNS = ((re.compile(r'/issue/byproject/[^/?]+'), '/issue/byproject/{project}'),
+                     (re.compile(r'/admin/project/[^/?]+'), '/admin/project/{project}'),
+                     (re.compile(r'/issue/[^/?]+'), '/issue/{issue}'))
 
 
 def urlquote(s):
@@ -26,6 +38,15 @@ def utf8encode(source):
     return source
 
 
+def endpoint_template(url):
+    # one label value per kind of call, not per issue or query
+    path = url.split('?', 1)[0]
+    for pattern, template in ENDPOINT_PATTERNS:
+        if pattern.search(path):
+            return pattern.sub(template, path, 1)
+    return path
+
+
 def relogin_on_401(f):
     @functools.wraps(f)
     def wrapped(self, *args, **kwargs):
@@ -38,6 +59,9 @@ def relogin_on_401(f):
                     raise e
                 if e.response.status == 504:
                     time.sleep(30)
+                elif getattr(self, '_credentials', None) is None:
+                    # unpickled connections carry no credentials
+                    raise e
                 else:
                     self._login(*self._credentials)
                 attempts -= 1
@@ -48,8 +72,10 @@ def relogin_on_401(f):
 
 class Connection(object):
     def __init__(self, url, login=None, password=None, proxy_info=None, api_key=None):
-        self.http = httplib2.Http(disable_ssl_certificate_validation=True) if proxy_info is None else httplib2.Http(
-            proxy_info=proxy_info, disable_ssl_certificate_validation=True)
+        # httplib2.Http is not thread safe, every request borrows one from a pool of idle (kept alive) transports
+        self._proxy_info = proxy_info
+        self._idle_http = []
+        self._http_lock = threading.Lock()
 
         # Remove the last character of the url ends with "/"
         if url:
@@ -57,14 +83,55 @@ class Connection(object):
 
         self.url = url
         self.baseUrl = url + "/rest"
+        # whom the calls run as, what one user fetched must not be handed to another
+        self.identity = (self.baseUrl, login if api_key is None else hashlib.sha256(api_key).hexdigest())
         if api_key is None:
             self._credentials = (login, password)
             self._login(*self._credentials)
         else:
             self.headers = {'X-YouTrack-ApiKey': api_key}
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_idle_http']
+        del state['_http_lock']
+        # pickles end up in caches on disk: neither the password nor the session cookie or api key go along
+        state.pop('_credentials', None)
+        state['headers'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._idle_http = []
+        self._http_lock = threading.Lock()
+
+    def _request(self, url, method='GET', *args, **kwargs):
+        with self._http_lock:
+            http = self._idle_http.pop() if self._idle_http else None
+        if http is None:
+            http = self._new_http()
+        endpoint = endpoint_template(url[len(self.baseUrl):] if url.startswith(self.baseUrl) else url)
+        start = time.time()
+        try:
+            # a transport that failed is dropped instead of returned to the pool
+            response, content = http.request(url, method, *args, **kwargs)
+        except Exception:
+            UPSTREAM_REQUESTS.inc(method, endpoint, 'error')
+            raise
+        finally:
+            UPSTREAM_SECONDS.observe(time.time() - start, method, endpoint)
+        UPSTREAM_REQUESTS.inc(method, endpoint, response.status)
+        with self._http_lock:
+            self._idle_http.append(http)
+        return response, content
+
+    def _new_http(self):
+        if self._proxy_info is None:
+            return httplib2.Http(disable_ssl_certificate_validation=True)
+        return httplib2.Http(proxy_info=self._proxy_info, disable_ssl_certificate_validation=True)
+
     def _login(self, login, password):
-        response, content = self.http.request(
+        response, content = self._request(
             self.baseUrl + "/user/login?login=" + urllib.quote_plus(login) + "&password=" + urllib.quote_plus(password),
             'POST',
             headers={'Content-Length': '0', 'Connection': 'keep-alive'})
@@ -83,7 +150,7 @@ class Connection(object):
             headers['Content-Type'] = content_type
             headers['Content-Length'] = str(len(body)) if body else '0'
 
-        response, content = self.http.request((self.baseUrl + url).encode('utf-8'), method, headers=headers, body=body)
+        response, content = self._request((self.baseUrl + url).encode('utf-8'), method, headers=headers, body=body)
         content = content.translate(None, '\0')
         _illegal_unichrs = [(0x00, 0x08), (0x0B, 0x0C), (0x0E, 0x1F),
                             (0x7F, 0x84), (0x86, 0x9F), (0xFDD0, 0xFDDF),
@@ -158,6 +225,10 @@ class Connection(object):
         return self._req('DELETE', '/issue/%s' % issue_id)
 
     def get_changes_for_issue(self, issue):
+        # concurrent dashboards of the same user ask for the same histories, only one request per issue goes out
+        return list(FLIGHTS.do(('get_changes_for_issue', self.identity, issue), self._get_changes_for_issue, issue))
+
+    def _get_changes_for_issue(self, issue):
         return [youtrack.IssueChange(change, self) for change in
                 self._get("/issue/%s/changes" % issue).getElementsByTagName('change')]
 
@@ -0,0 +1,56 @@
+import calendar
+from operator import attrgetter
+
+import numpy
+
+# the first and the last point plus at least one bucket in between
+MIN_THRESHOLD = 3
+
+
+def lttb_indices(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets: indices of at most threshold points that keep the visual shape of the series.
+
+    x has to be sorted. The first and the last point are always kept, from every bucket in between the point spanning
+    the largest triangle with the previously kept point and the average of the next bucket, so outliers survive.
+    A threshold of None keeps all points, thresholds below MIN_THRESHOLD are rejected.
+    """
+    check_threshold(threshold)
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    length = len(x)
+    if threshold is None or threshold >= length:
+        return numpy.arange(length)
+
+    edges = numpy.linspace(1, length - 1, threshold - 1).astype(numpy.int64)
+    edges = numpy.append(edges, length)
+    selected = numpy.empty(threshold, dtype=numpy.int64)
+    selected[0] = previous = 0
+    selected[-1] = length - 1
+    for bucket in range(threshold - 2):
+        start, end, next_end = edges[bucket], edges[bucket + 1], edges[bucket + 2]
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        areas = numpy.abs((x[previous] - next_x) * (y[start:end] - y[previous]) -
+                          (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(areas.argmax())
+        selected[bucket + 1] = previous
+    return selected
+
+
+def check_threshold(threshold):
+    if threshold is not None and threshold < MIN_THRESHOLD:
+        raise ValueError('at least %d points are needed to keep the shape, not %d' % (MIN_THRESHOLD, threshold))
+
+
+def downsample_issues(issues, point_budget):
+    # issues by resolved date, thinned to the point budget of a control chart, no budget keeps them all
+    issues = sorted(issues, key=attrgetter('resolved_date'))
+    if not point_budget:
+        return issues
+    check_threshold(point_budget)
+    if len(issues) <= point_budget:
+        return issues
+    resolved = [calendar.timegm(issue.resolved_date.utctimetuple()) for issue in issues]
+    cycle_times = [issue.cycle_time.total_seconds() for issue in issues]
+    return [issues[index] for index in lttb_indices(resolved, cycle_times, point_budget)]
@@ -0,0 +1,120 @@
+import csv
+import datetime
+import os
+from itertools import islice
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+ISSUE_COLUMNS = (('project', 'string'), ('issue_id', 'string'), ('created_time', 'timestamp'),
+                 ('resolved_date', 'timestamp'), ('cycle_time_start', 'timestamp'), ('cycle_time_end', 'timestamp'),
+                 ('cycle_time_days', 'float'), ('cycle_time_start_source_transition', 'string'),
+                 ('cycle_time_end_source_transition', 'string'))
+
+TRANSITION_COLUMNS = (('project', 'string'), ('issue_id', 'string'), ('from_state', 'string'),
+                      ('to_state', 'string'), ('updated', 'timestamp'), ('duration_days', 'float'))
+
+
+def issue_row(issue):
+    return (project_of(issue.issue_id), issue.issue_id, issue.created_time, issue.resolved_date,
+            issue.cycle_time_start, issue.cycle_time_end, to_days(issue.cycle_time),
+            issue.cycle_time_start_source_transition, issue.cycle_time_end_source_transition)
+
+
+def transition_rows(issue):
+    return [(project_of(issue.issue_id), issue.issue_id, state_change.from_state, state_change.to_state,
+             state_change.updated, to_days(state_change.duration)) for state_change in issue.state_changes]
+
+
+def project_of(issue_id):
+    return issue_id.rsplit('-', 1)[0]
+
+
+def to_days(duration):
+    return duration.total_seconds() / 86400
+
+
+class CsvTableWriter(object):
+    extension = 'csv'
+
+    def __init__(self, filename, columns):
+        self._file = open(filename, 'wb')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow([name for name, column_type in columns])
+
+    def write(self, rows):
+        self._writer.writerows([[csv_value(value) for value in row] for row in rows])
+
+    def close(self):
+        self._file.close()
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class ParquetTableWriter(object):
+    extension = 'parquet'
+
+    def __init__(self, filename, columns):
+        self._schema = pyarrow.schema([pyarrow.field(name, arrow_type(column_type)) for name, column_type in columns])
+        self._writer = pyarrow.parquet.ParquetWriter(filename, self._schema)
+
+    def write(self, rows):
+        if not rows:
+            return
+        columns = zip(*rows)
+        self._writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type) for column, field in zip(columns, self._schema)],
+            schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+def arrow_type(column_type):
+    return {'string': pyarrow.string(), 'timestamp': pyarrow.timestamp('ms'), 'float': pyarrow.float64()}[column_type]
+
+
+def table_writer_class(export_format='auto'):
+    if export_format == 'parquet' or (export_format == 'auto' and pyarrow is not None):
+        if pyarrow is None:
+            raise ValueError('parquet export needs pyarrow')
+        return ParquetTableWriter
+    return CsvTableWriter
+
+
+def export_issues(issues, directory, export_format='auto', chunk_size=1000):
+    # the issues are consumed chunk by chunk, so an issue iterator is exported in constant memory
+    writer_class = table_writer_class(export_format)
+    filenames = {'issues': os.path.join(directory, 'issues.%s' % writer_class.extension),
+                 'transitions': os.path.join(directory, 'transitions.%s' % writer_class.extension)}
+    exported = 0
+    issue_writer = writer_class(filenames['issues'], ISSUE_COLUMNS)
+    try:
+        transition_writer = writer_class(filenames['transitions'], TRANSITION_COLUMNS)
+        try:
+            issues = iter(issues)
+            while True:
+                chunk = list(islice(issues, chunk_size))
+                if not chunk:
+                    break
+                issue_writer.write([issue_row(issue) for issue in chunk])
+                transition_writer.write([row for issue in chunk for row in transition_rows(issue)])
+                exported += len(chunk)
+        finally:
+            transition_writer.close()
+    finally:
+        issue_writer.close()
+    return exported, filenames
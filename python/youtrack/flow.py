@@ -0,0 +1,140 @@
+import datetime
+from bisect import bisect_right
+from operator import attrgetter
+
+import numpy
+
+from quantiles import PERCENTILES
+
+
+class DailyFlow(object):
+    def __init__(self, first_day, wip, arrivals, departures):
+        self.first_day = first_day
+        self.wip = wip
+        self.arrivals = arrivals
+        self.departures = departures
+
+    @property
+    def dates(self):
+        return [self.first_day + datetime.timedelta(days=offset) for offset in range(len(self.wip))]
+
+    @property
+    def mean_wip(self):
+        return self.wip.mean()
+
+    @property
+    def max_wip(self):
+        return self.wip.max()
+
+
+def day_offsets(datetimes, first_day):
+    return numpy.fromiter((value.toordinal() for value in datetimes), dtype=numpy.int64) - first_day.toordinal()
+
+
+def daily_flow(issues, then, now):
+    # each issue is a +1 event on the day its cycle time starts and a -1 event on the day it ends.
+    # events before the window carry into the first day, events after the window land in an overflow bin.
+    first_day = then.date() if isinstance(then, datetime.datetime) else then
+    days = now.toordinal() - first_day.toordinal() + 1
+    start_offsets = day_offsets([issue.cycle_time_start for issue in issues], first_day)
+    end_offsets = day_offsets([issue.cycle_time_end for issue in issues], first_day)
+    started = numpy.bincount(numpy.clip(start_offsets, 0, days), minlength=days + 1)[:days]
+    finished = numpy.bincount(numpy.clip(end_offsets, 0, days), minlength=days + 1)[:days]
+    return DailyFlow(first_day, numpy.cumsum(started - finished),
+                     in_window_counts(start_offsets, days), in_window_counts(end_offsets, days))
+
+
+def in_window_counts(offsets, days):
+    return numpy.bincount(offsets[(offsets >= 0) & (offsets < days)], minlength=days)
+
+
+class CumulativeFlow(object):
+    def __init__(self, first_day, states, in_state, arrivals):
+        self.first_day = first_day
+        self.states = states
+        self.in_state = in_state
+        self.arrivals = arrivals
+
+    @property
+    def dates(self):
+        return [self.first_day + datetime.timedelta(days=offset) for offset in range(len(self.in_state))]
+
+    def bands(self):
+        # (state, lower, upper) from the most downstream state at the bottom to the most upstream on top
+        lower = numpy.zeros(len(self.in_state), dtype=self.in_state.dtype)
+        for index in reversed(range(len(self.states))):
+            upper = lower + self.in_state[:, index]
+            yield self.states[index], lower, upper
+            lower = upper
+
+
+def cumulative_flow(issues, then, now, states=None):
+    # every state change closes the period its issue spent in from_state; the last one opens a period
+    # in the final state that lasts beyond the window.
+    first_day = then.date() if isinstance(then, datetime.datetime) else then
+    days = now.toordinal() - first_day.toordinal() + 1
+    beyond_window = datetime.date.fromordinal(first_day.toordinal() + days)
+    period_states, entered, left = [], [], []
+    for issue in issues:
+        for state_change in issue.state_changes:
+            period_states.append(state_change.from_state)
+            entered.append(state_change.updated - state_change.duration)
+            left.append(state_change.updated)
+        if issue.state_changes:
+            period_states.append(issue.state_changes[-1].to_state)
+            entered.append(issue.state_changes[-1].updated)
+            left.append(beyond_window)
+
+    entry_offsets = day_offsets(entered, first_day)
+    if states is None:
+        states = workflow_order(period_states, entry_offsets)
+    state_index = dict((state, index) for index, state in enumerate(states))
+    state_indices = numpy.array([state_index.get(state, -1) for state in period_states], dtype=numpy.int64)
+    known = state_indices >= 0
+
+    width = len(states)
+    entries = binned_states(numpy.clip(entry_offsets, 0, days)[known], state_indices[known], days, width)
+    exits = binned_states(numpy.clip(day_offsets(left, first_day), 0, days)[known], state_indices[known], days,
+                          width)
+    return CumulativeFlow(first_day, states, numpy.cumsum(entries - exits, axis=0)[:days],
+                          numpy.cumsum(entries, axis=0)[:days])
+
+
+def binned_states(offsets, state_indices, days, width):
+    return numpy.bincount(offsets * width + state_indices, minlength=(days + 1) * width).reshape(days + 1, width)
+
+
+def workflow_order(period_states, entry_offsets):
+    # states entered earlier on average are further upstream
+    states = sorted(set(period_states))
+    if not states:
+        return []
+    state_index = dict((state, index) for index, state in enumerate(states))
+    indices = numpy.array([state_index[state] for state in period_states], dtype=numpy.int64)
+    mean_entry = numpy.bincount(indices, weights=entry_offsets, minlength=len(states)) / numpy.bincount(
+        indices, minlength=len(states))
+    return [states[index] for index in numpy.argsort(mean_entry, kind='mergesort')]
+
+
+class AgingIssue(object):
+    def __init__(self, issue, age, percentile):
+        self.issue = issue
+        self.age = age
+        # the highest percentile of the finished issues' cycle times this issue is already older than
+        self.percentile = percentile
+
+    def __str__(self):
+        if self.percentile is None:
+            return '[%s] in [%s] for %d days' % (self.issue.issue_id, self.issue.current_state, self.age.days)
+        return '[%s] in [%s] for %d days, older than %d%% of finished issues' % (
+            self.issue.issue_id, self.issue.current_state, self.age.days, self.percentile)
+
+
+def aging_wip(issues, digest, now, quantiles=PERCENTILES):
+    thresholds = digest.percentiles(quantiles)
+    aging_issues = []
+    for issue in issues:
+        age = issue.age(now)
+        exceeded = bisect_right(thresholds, age.days)
+        aging_issues.append(AgingIssue(issue, age, quantiles[exceeded - 1] if exceeded else None))
+    return sorted(aging_issues, key=attrgetter('age'), reverse=True)
@@ -0,0 +1,94 @@
+import datetime
+import math
+from multiprocessing import Pool
+
+import numpy
+
+from flow import day_offsets, in_window_counts
+
+CONFIDENCES = (50, 85, 95)
+
+
+def daily_throughput(issues, then, now):
+    first_day = then.date() if isinstance(then, datetime.datetime) else then
+    days = now.toordinal() - first_day.toordinal() + 1
+    return in_window_counts(day_offsets([issue.resolved_date for issue in issues], first_day), days)
+
+
+class MonteCarloForecast(object):
+    """
+    Resamples the historical daily throughput: every trial draws one past day per future day.
+    Trials are simulated in chunks as numpy matrices, optionally spread over a process pool.
+    """
+
+    def __init__(self, throughput, trials=10000, processes=None, seed=None, chunk_size=10000):
+        self.throughput = numpy.asarray(throughput, dtype=numpy.int64)
+        if not self.throughput.any():
+            raise ValueError('no throughput in history')
+        self.trials = trials
+        self.processes = processes
+        self.seed = seed
+        self.chunk_size = chunk_size
+
+    def items_by(self, days):
+        return self._simulate(simulate_items, days)
+
+    def days_until(self, items):
+        return self._simulate(simulate_days_until, items)
+
+    def items_forecast(self, days, confidences=CONFIDENCES):
+        # at least this many items with the given certainty
+        outcomes = self.items_by(days)
+        return [(confidence, int(math.floor(numpy.percentile(outcomes, 100 - confidence))))
+                for confidence in confidences]
+
+    def days_forecast(self, items, confidences=CONFIDENCES):
+        # done within this many days with the given certainty
+        outcomes = self.days_until(items)
+        return [(confidence, int(math.ceil(numpy.percentile(outcomes, confidence)))) for confidence in confidences]
+
+    def _simulate(self, simulation, target):
+        chunks = []
+        for index, start in enumerate(range(0, self.trials, self.chunk_size)):
+            seed = None if self.seed is None else self.seed + index
+            chunks.append((self.throughput, target, min(self.chunk_size, self.trials - start), seed))
+        if self.processes and len(chunks) > 1:
+            pool = Pool(self.processes)
+            try:
+                results = pool.map(simulation, chunks)
+            finally:
+                # the results are in or the simulation failed, either way the workers are done
+                pool.terminate()
+                pool.join()
+        else:
+            results = map(simulation, chunks)
+        return numpy.concatenate(results)
+
+
+def simulate_items(chunk):
+    throughput, days, trials, seed = chunk
+    if days <= 0:
+        return numpy.zeros(trials, dtype=numpy.int64)
+    random_state = numpy.random.RandomState(seed)
+    return random_state.choice(throughput, size=(trials, days)).sum(axis=1)
+
+
+def simulate_days_until(chunk):
+    throughput, items, trials, seed = chunk
+    days = numpy.zeros(trials, dtype=numpy.int64)
+    if items <= 0:
+        return days
+    random_state = numpy.random.RandomState(seed)
+    done = numpy.zeros(trials, dtype=numpy.int64)
+    pending = numpy.arange(trials)
+    horizon = int(math.ceil(items / throughput.mean()))
+    elapsed = 0
+    while pending.size:
+        cumulative = numpy.cumsum(random_state.choice(throughput, size=(pending.size, horizon)), axis=1)
+        cumulative += done[pending, numpy.newaxis]
+        reached = cumulative[:, -1] >= items
+        days[pending[reached]] = elapsed + numpy.argmax(cumulative[reached] >= items, axis=1) + 1
+        done[pending[~reached]] = cumulative[~reached, -1]
+        pending = pending[~reached]
+        elapsed += horizon
+    return days
@@ -0,0 +1,154 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# seconds, from a cache hit to a cold fetch of a whole project
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def escape_label(value):
+    return ('%s' % value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = ['%s="%s"' % (name, escape_label(value)) for name, value in zip(names, values) + list(extra)]
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, **kwargs):
+        amount = kwargs.get('amount', 1)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['%s%s %s' % (self.name, format_labels(self.label_names, labels), format_value(value))
+                for labels, value in values]
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts, total = self._values.get(labels, ([0] * len(self.buckets), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[labels] = (counts, total + value)
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, *labels)
+
+    def timed(self, *labels):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapped(*args, **kwargs):
+                with self.time(*labels):
+                    return function(*args, **kwargs)
+
+            return wrapped
+
+        return decorator
+
+    def count(self, *labels):
+        with self._lock:
+            return sum(self._values.get(labels, ((0,), 0.0))[0])
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        lines = []
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, format_labels(self.label_names, labels,
+                                                                          [('le', format_value(bucket))]),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (self.name, format_labels(self.label_names, labels), format_value(total)))
+            lines.append('%s_count%s %d' % (self.name, format_labels(self.label_names, labels), cumulative))
+        return lines
+
+
+class Gauge(object):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function):
+        # read when the metrics are scraped, e.g. the size of a cache
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def samples(self):
+        return ['%s %s' % (self.name, format_value(self.function()))]
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def gauge(self, name, documentation, function):
+        # gauges are re-registered with the latest function, the objects they read may have been replaced
+        with self._lock:
+            gauge = self._metrics[name] = Gauge(name, documentation, function)
+            return gauge
+
+    def exposition(self):
+        # prometheus text exposition format, version 0.0.4
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
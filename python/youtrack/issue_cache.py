@@ -0,0 +1,113 @@
+import datetime
+import json
+import os
+import threading
+import time
+
+import pyfscache
+
+from instrumentation import REGISTRY
+
+# one json line per run next to the cache entries, whose file names are digests of their keys
+RUNS_FILE = 'runs.log'
+AGE_BUCKETS = (('1 hour', datetime.timedelta(hours=1)), ('6 hours', datetime.timedelta(hours=6)),
+               ('1 day', datetime.timedelta(days=1)), ('1 week', datetime.timedelta(days=7)))
+
+CACHE_LOOKUPS = REGISTRY.counter('kanban_issue_cache_lookups_total', 'Issue sets looked up in the file system cache',
+                                 ('result',))
+
+
+class IssueCache(object):
+    """
+    pyfscache.FSCache counting its hits and misses, the counts of every run are appended to the runs file.
+    KanbanAwareYouTrackConnection keys its entries by server, user and project.
+    """
+
+    def __init__(self, path, days):
+        self._cache = pyfscache.FSCache(path, days=days)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def path(self):
+        return self._cache.path
+
+    def __contains__(self, key):
+        contained = key in self._cache
+        with self._lock:
+            if contained:
+                self.hits += 1
+            else:
+                self.misses += 1
+        CACHE_LOOKUPS.inc('hit' if contained else 'miss')
+        return contained
+
+    def __getitem__(self, key):
+        return self._cache[key]
+
+    def __setitem__(self, key, value):
+        self._cache[key] = value
+
+    def record_run(self, command, now=None):
+        run = {'time': time.mktime((now or datetime.datetime.now()).timetuple()), 'command': command,
+               'hits': self.hits, 'misses': self.misses}
+        with open(os.path.join(self.path, RUNS_FILE), 'a') as runs:
+            runs.write(json.dumps(run) + '\n')
+
+
+def read_runs(path):
+    filename = os.path.join(path, RUNS_FILE)
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as runs:
+        return [json.loads(line) for line in runs if line.strip()]
+
+
+class CacheStats(object):
+    def __init__(self, path, lifetime, now=None, last_runs=10):
+        now = now or datetime.datetime.now()
+        self.path = path
+        self.lifetime = lifetime
+        self.entries = 0
+        self.bytes = 0
+        self.expired = 0
+        self.ages = [0] * (len(AGE_BUCKETS) + 1)
+        self.oldest = None
+        # a cache that was never written to is reported empty
+        self.missing = not os.path.isdir(path)
+        for name in [] if self.missing else os.listdir(path):
+            if name == RUNS_FILE:
+                continue
+            filename = os.path.join(path, name)
+            # entries are never rewritten, their modification time is when they were stored
+            age = now - datetime.datetime.fromtimestamp(os.path.getmtime(filename))
+            self.entries += 1
+            self.bytes += os.path.getsize(filename)
+            self.ages[sum(1 for _, bucket in AGE_BUCKETS if age >= bucket)] += 1
+            if age > lifetime:
+                self.expired += 1
+            if self.oldest is None or age > self.oldest:
+                self.oldest = age
+        self.runs = read_runs(path)[-last_runs:]
+
+    def lines(self):
+        lines = ['cache directory: %s%s' % (self.path, ' (missing)' if self.missing else ''),
+                 'entries: %d (%d expired after %d days)' % (self.entries, self.expired, self.lifetime.days),
+                 'size: %.1f MiB (%d bytes)' % (self.bytes / 1024.0 / 1024.0, self.bytes)]
+        if self.oldest is not None:
+            lines.append('oldest entry: %s' % self.oldest)
+        for (label, _), count in zip(AGE_BUCKETS, self.ages):
+            lines.append('  younger than %-7s: %d' % (label, count))
+        lines.append('  older than %-9s: %d' % (AGE_BUCKETS[-1][0], self.ages[-1]))
+        lines.append('last runs:')
+        for run in self.runs:
+            lookups = run['hits'] + run['misses']
+            hit_rate = '%5.1f%%' % (100.0 * run['hits'] / lookups) if lookups else '    -'
+            lines.append('  %s %-10s hits %4d misses %4d hit rate %s' % (
+                datetime.datetime.fromtimestamp(run['time']).strftime('%Y-%m-%d %H:%M'), run['command'],
+                run['hits'], run['misses'], hit_rate))
+        return lines
+
+    def __str__(self):
+        return '\n'.join(self.lines())
@@ -1,8 +1,27 @@
+import copy
 import datetime
 import logging
+import shelve
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
 from operator import attrgetter
 
+import pyfscache
+
 from connection import Connection
+from instrumentation import REGISTRY
+from singleflight import FLIGHTS
+
+CYCLE_TIME_STATES = ('In Progress', 'Review', 'Code Review', 'Analysis', 'Development',
+                     'Verification', 'Testing | Verification', 'Ready for Code Review')
+
+FETCH_SECONDS = REGISTRY.histogram('kanban_fetch_seconds', 'Duration of fetching the issues of a project with their '
+                                   'change histories', ('operation',))
+FETCHED_ISSUES = REGISTRY.counter('kanban_fetched_issues_total', 'Issues fetched with their change histories',
+                                  ('operation',))
+HISTORY_STORE_LOOKUPS = REGISTRY.counter('kanban_history_store_lookups_total', 'Change histories looked up in the '
+                                         'history store', ('result',))
 
 
 class ChangesProvider(object):
@@ -18,6 +37,75 @@ class YoutrackProvider(ChangesProvider):
         return self.youtrack.get_changes_for_issue(issue.issue_id)
 
 
+class IncrementalHistoryProvider(YoutrackProvider):
+    def __init__(self, youtrack, history_store):
+        YoutrackProvider.__init__(self, youtrack)
+        self.history_store = history_store
+
+    def __getstate__(self):
+        # the issues keep their provider, pickling them must not take the shelve and its lock along
+        state = dict(self.__dict__)
+        state['history_store'] = None
+        return state
+
+    def retrieve_changes(self, issue):
+        if self.history_store is None:
+            return YoutrackProvider.retrieve_changes(self, issue)
+        changes = self.history_store.get(issue.issue_id, issue.updated)
+        if changes is None:
+            changes = YoutrackProvider.retrieve_changes(self, issue)
+            self.history_store.put(issue.issue_id, issue.updated, changes)
+        return changes
+
+
+class HistoryStore(object):
+    """
+    Change histories by issue id, kept together with the issue's update time of when they were fetched.
+    A history is only handed out again while the issue has not been updated since.
+    """
+
+    def __init__(self, filename):
+        self._shelf = shelve.open(filename, protocol=2)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, issue_id, updated):
+        with self._lock:
+            stored = self._shelf.get(utf8_key(issue_id))
+            if stored is None or updated is None or stored[0] < updated:
+                self.misses += 1
+                HISTORY_STORE_LOOKUPS.inc('miss')
+                return None
+            self.hits += 1
+            HISTORY_STORE_LOOKUPS.inc('hit')
+            return stored[1]
+
+    def put(self, issue_id, updated, changes):
+        if updated is None:
+            return
+        # the changes refer back to the connection, which must not end up on disk, the caller keeps using them
+        changes = [detached(change) for change in changes]
+        with self._lock:
+            self._shelf[utf8_key(issue_id)] = (updated, changes)
+
+    def close(self):
+        with self._lock:
+            self._shelf.close()
+
+
+def detached(youtrack_object):
+    stored = copy.copy(youtrack_object)
+    stored.youtrack = None
+    if hasattr(stored, 'fields'):
+        stored.fields = [detached(field) for field in stored.fields]
+    return stored
+
+
+def utf8_key(key):
+    return key.encode('utf-8') if isinstance(key, unicode) else key
+
+
 class ProjectNotFoundException(Exception):
     pass
 
@@ -25,40 +113,133 @@ class ProjectNotFoundException(Exception):
 # noinspection PyAbstractClass
 class KanbanAwareYouTrackConnection(Connection):
     def __init__(self, url, username, password, cache=None, *args, **kwargs):
+        # keyword only, positional extras still go to Connection (proxy_info, api_key)
+        self.retain_changes = kwargs.pop('retain_changes', True)
+        self.workers = kwargs.pop('workers', 1)
+        self.history_store = kwargs.pop('history_store', None)
         Connection.__init__(self, url, username, password, *args, **kwargs)
         self._log = logging.getLogger(self.__class__.__name__)
         self._log.debug('connected to [%s@%s]' % (username, self.baseUrl))
         if cache:
-            self.get_cycle_time_issues = cache(self.get_cycle_time_issues)
+            self.get_cycle_time_issues = pyfscache.cache_function(self.get_cycle_time_issues, self._cache_key, cache)
 
     def __getstate__(self):
-        state = dict(self.__dict__)
+        state = Connection.__getstate__(self)
         del state['_log']
-        del state['get_cycle_time_issues']
+        state.pop('get_cycle_time_issues', None)
+        state['history_store'] = None
         return state
 
-    def get_cycle_time_issues(self, project, items, history_range=None):
-        projects = self.getProjects()
-        if project not in projects and project not in projects.values():
-            raise ProjectNotFoundException('[%s] not in [%s]' % (project, projects))
+    def __setstate__(self, state):
+        Connection.__setstate__(self, state)
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    def _cache_key(self, project, items, history_range=None, workers=None):
+        # the same project on another server, for another user or with released changes is a different entry
+        return 'get_cycle_time_issues', self.identity, self.retain_changes, project, items, history_range
+
+    def get_cycle_time_issues(self, project, items, history_range=None, workers=None):
+        # identical requests of one user while one is in flight wait for it and share its issues, other users fetch
+        # with their own permissions
+        key = ('get_cycle_time_issues', self.identity, project, items, history_range, self.retain_changes)
+        return list(FLIGHTS.do(key, self._get_cycle_time_issues, project, items, history_range, workers))
+
+    @FETCH_SECONDS.timed('cycle_time')
+    def _get_cycle_time_issues(self, project, items, history_range=None, workers=None):
+        self._check_project(project)
+        all_issues = self.getIssues(project, resolved_filter(history_range), 0, items)
         if history_range:
-            all_issues = self.getIssues(project, 'state:resolved resolved date:%s .. %s' % history_range, 0, items)
             self._log.debug('found %d issues in range %s' % (len(all_issues), history_range))
         else:
-            all_issues = self.getIssues(project, 'state:resolved', 0, items)
             self._log.debug('found %d issues' % len(all_issues))
         cycle_time_issues = filter(lambda issue: issue.cycle_time is not None,
-                                   [CycleTimeAwareIssue(one_issue, YoutrackProvider(self)) for one_issue in
-                                    all_issues])
+                                   thread_map(self._cycle_time_issue, all_issues, workers or self.workers))
         self._log.debug('found %d issues with cycle times' % len(cycle_time_issues))
+        FETCHED_ISSUES.inc('cycle_time', amount=len(cycle_time_issues))
+        if cycle_time_issues and self._log.isEnabledFor(logging.INFO):
+            self._log.info('memory per issue: %d bytes (changes retained: %s)' % (
+                mean_memory_size(cycle_time_issues), self.retain_changes))
         return cycle_time_issues
 
+    def iter_cycle_time_issues(self, project, items, history_range=None, batch_size=100):
+        self._check_project(project)
+        for after in xrange(0, items, batch_size):
+            issues = self.getIssues(project, resolved_filter(history_range), after, min(batch_size, items - after))
+            self._log.debug('fetched %d issues after %d' % (len(issues), after))
+            for cycle_time_issue in thread_map(self._cycle_time_issue, issues, self.workers):
+                if cycle_time_issue.cycle_time is not None:
+                    FETCHED_ISSUES.inc('iter_cycle_time')
+                    yield cycle_time_issue
+            if len(issues) < batch_size:
+                break
+
+    @FETCH_SECONDS.timed('aging')
+    def get_aging_issues(self, project, items, workers=None):
+        self._check_project(project)
+        open_issues = self.getIssues(project, in_progress_filter(), 0, items)
+        self._log.debug('found %d issues in progress' % len(open_issues))
+        FETCHED_ISSUES.inc('aging', amount=len(open_issues))
+        return thread_map(self._cycle_time_issue, open_issues, workers or self.workers)
+
+    def _cycle_time_issue(self, issue):
+        if self.history_store is not None:
+            return CycleTimeAwareIssue(issue, IncrementalHistoryProvider(self, self.history_store),
+                                       self.retain_changes)
+        return CycleTimeAwareIssue(issue, YoutrackProvider(self), self.retain_changes)
+
+    def _check_project(self, project):
+        projects = self.getProjects()
+        if project not in projects and project not in projects.values():
+            raise ProjectNotFoundException('[%s] not in [%s]' % (project, projects))
+
+
+def thread_map(function, items, workers):
+    # the work is dominated by waiting for YouTrack, so threads are enough to overlap it
+    if workers > 1 and len(items) > 1:
+        pool = ThreadPool(min(workers, len(items)))
+        try:
+            return pool.map(function, items)
+        finally:
+            pool.close()
+    return map(function, items)
+
+
+def resolved_filter(history_range=None):
+    if history_range:
+        return 'state:resolved resolved date:%s .. %s' % history_range
+    return 'state:resolved'
+
+
+def in_progress_filter(states=CYCLE_TIME_STATES):
+    return '#Unresolved state:%s' % ', '.join('{%s}' % state for state in states)
+
 
 def millis_to_datetime(time_str):
     return datetime.datetime.fromtimestamp(time_str / 1000.0)
 
 
-class data:
+def deep_sizeof(obj, seen=None):
+    # shared objects (connection, loggers) are not owned by a single issue and therefore not counted
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, (Connection, logging.Logger)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    return size
+
+
+def mean_memory_size(issues):
+    return sum(issue.memory_size() for issue in issues) // len(issues)
+
+
+class data(object):
     @staticmethod
     def repr(obj):
         items = []
@@ -72,12 +253,10 @@ class data:
 
         return "%s(%s)" % (obj.__class__.__name__, ', '.join(items))
 
-    def __init__(self, cls):
-        cls.__repr__ = data.repr
-        self.cls = cls
-
-    def __call__(self, *args, **kwargs):
-        return self.cls(*args, **kwargs)
+    def __new__(cls, decorated):
+        # hand back the decorated class itself, so that its instances stay picklable
+        decorated.__repr__ = data.repr
+        return decorated
 
 
 @data
@@ -94,16 +273,17 @@ class StateChange(object):
 
 
 class CycleTimeAwareIssue(object):
-    def __init__(self, issue, history_provider=None):
+    def __init__(self, issue, history_provider=None, retain_changes=True):
         self._log = logging.getLogger(self.__class__.__name__)
         self.issue_id = issue.id
         self.created_time = millis_to_datetime(int(issue.created))
+        self.updated = int(issue.updated) if hasattr(issue, 'updated') else None
         self.history_provider = history_provider
         self.changes = self.history_provider.retrieve_changes(self)
         self._init_time_in_state()
-        self._calculate_cycle_time(
-            ('In Progress', 'Review', 'Code Review', 'Analysis', 'Development',
-             'Verification', 'Testing | Verification', 'Ready for Code Review'))
+        self._calculate_cycle_time(CYCLE_TIME_STATES)
+        if not retain_changes:
+            self.release_changes()
 
         self._log.info(str(self))
 
@@ -112,6 +292,11 @@ class CycleTimeAwareIssue(object):
         del state['_log']
         return state
 
+    def __setstate__(self, state):
+        # issues read from the cache are pickled again when they are handed to the batch processes
+        self.__dict__.update(state)
+        self._log = logging.getLogger(self.__class__.__name__)
+
     def __str__(self):
         return '[%(issue_id)s], (created): %(created_time)s, ' \
                '(%(cycle_time_start_source_transition)s): %(cycle_time_start)s, ' \
@@ -159,6 +344,23 @@ class CycleTimeAwareIssue(object):
                 if resolved_field.new_value:
                     self.resolved_date = millis_to_datetime(int(resolved_field.new_value[0]))
 
+    def release_changes(self):
+        # everything derived from the raw history lives in state_changes and the cycle time fields
+        self.changes = ()
+        self.history_provider = None
+
+    def memory_size(self):
+        return deep_sizeof(self)
+
+    @property
+    def current_state(self):
+        if not self.state_changes:
+            return None
+        return max(self.state_changes, key=attrgetter('updated')).to_state
+
+    def age(self, now):
+        return now - self.cycle_time_start
+
     def time_in_state(self, state):
         return sum(
             [state_change.duration for state_change in filter(lambda s: s.from_state == state, self.state_changes)],
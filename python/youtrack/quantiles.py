@@ -0,0 +1,150 @@
+from bisect import bisect_right
+
+import numpy
+
+from kanban_metrics import data
+
+PERCENTILES = (10, 25, 50, 75, 80, 90, 95, 99)
+
+
+class TDigest(object):
+    """
+    Mergeable quantile sketch (merging t-digest).
+
+    Values are buffered and periodically folded into a sorted list of (mean, weight) centroids whose size is
+    bounded by the compression: centroids near the median may absorb many values, the tails stay (almost)
+    exact. As long as no two values were merged the percentiles match numpy's linear interpolation.
+    """
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.count = 0
+        self.min = None
+        self.max = None
+        self._centroids = []
+        self._buffer = []
+
+    @classmethod
+    def from_values(cls, values, compression=100):
+        return cls(compression).update(values)
+
+    def __len__(self):
+        return self.count
+
+    def __getstate__(self):
+        self._compress()
+        return dict(self.__dict__)
+
+    def add(self, value, weight=1):
+        value = float(value)
+        self._buffer.append((value, weight))
+        self._extend_range(value, value, weight)
+        return self
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+    def merge(self, other):
+        if other.count:
+            self._buffer.extend(other.centroids())
+            self._extend_range(other.min, other.max, other.count)
+        return self
+
+    def centroids(self):
+        self._compress()
+        return list(self._centroids)
+
+    def percentile(self, quantile):
+        centroids = self.centroids()
+        if not centroids:
+            raise ValueError('no values in digest')
+        index = quantile / 100.0 * (self.count - 1)
+        # interpolate between the centroid centers, expressed as (fractional) rank of the sorted values
+        previous_index, previous_value = 0.0, self.min
+        cumulative = 0
+        for mean, weight in centroids:
+            center = cumulative + (weight - 1) / 2.0
+            if index <= center:
+                return _interpolate(previous_index, previous_value, center, mean, index)
+            previous_index, previous_value = center, mean
+            cumulative += weight
+        return _interpolate(previous_index, previous_value, self.count - 1, self.max, index)
+
+    def percentiles(self, quantiles=PERCENTILES):
+        return [self.percentile(quantile) for quantile in quantiles]
+
+    def _extend_range(self, low, high, weight):
+        self.count += weight
+        if self.min is None or low < self.min:
+            self.min = low
+        if self.max is None or high > self.max:
+            self.max = high
+        if len(self._buffer) >= 5 * self.compression:
+            self._compress()
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        points = sorted(self._centroids + self._buffer)
+        self._buffer = []
+        total = float(self.count)
+        centroids = []
+        cumulative = 0
+        mean, weight = points[0]
+        for next_mean, next_weight in points[1:]:
+            proposed_weight = weight + next_weight
+            quantile = (cumulative + proposed_weight / 2.0) / total
+            if proposed_weight <= 4 * total * quantile * (1 - quantile) / self.compression:
+                mean += (next_mean - mean) * next_weight / float(proposed_weight)
+                weight = proposed_weight
+            else:
+                centroids.append((mean, weight))
+                cumulative += weight
+                mean, weight = next_mean, next_weight
+        centroids.append((mean, weight))
+        self._centroids = centroids
+
+
+def _interpolate(left_index, left_value, right_index, right_value, index):
+    if right_index <= left_index:
+        return right_value
+    return left_value + (right_value - left_value) * (index - left_index) / (right_index - left_index)
+
+
+def merge_digests(digests, compression=100):
+    merged = TDigest(compression)
+    for digest in digests:
+        merged.merge(digest)
+    return merged
+
+
+def cycle_time_digest(issues, compression=100):
+    return TDigest.from_values((issue.cycle_time.days for issue in issues), compression)
+
+
+@data
+class PercentileBucket(object):
+    def __init__(self, quantile, cycle_time, issues):
+        self.quantile = quantile
+        self.cycle_time = cycle_time
+        self.issues = issues
+
+    def __str__(self):
+        return '%d%% percentile: %s days' % (self.quantile, self.cycle_time)
+
+
+def percentile_breakdown(issues, quantiles=PERCENTILES):
+    # every issue lands in the first percentile whose cycle time it does not exceed
+    sorted_issues = sorted(issues, key=lambda issue: issue.cycle_time.days)
+    if not sorted_issues:
+        return []
+    cycle_times = [issue.cycle_time.days for issue in sorted_issues]
+    buckets = []
+    lower = 0
+    for quantile, quantile_cycle_time in zip(quantiles, numpy.percentile(cycle_times, quantiles)):
+        upper = max(lower, bisect_right(cycle_times, quantile_cycle_time))
+        buckets.append(PercentileBucket(quantile, quantile_cycle_time, sorted_issues[lower:upper]))
+        lower = upper
+    return buckets
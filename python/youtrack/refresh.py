@@ -0,0 +1,151 @@
+import datetime
+import logging
+import threading
+
+
+class CachedResult(object):
+    def __init__(self, value, computed):
+        self.value = value
+        self.computed = computed
+
+    def age(self, now=None):
+        return (now or datetime.datetime.now()) - self.computed
+
+
+class BackgroundRefresher(object):
+    """
+    Stale-while-revalidate cache: the last good result of compute(key) is served immediately, a result older than
+    max_age triggers a refresh in a background thread. A failed refresh keeps the previous result.
+    Results of keys nobody asked for within idle_timeout are evicted, as are the least recently requested ones beyond
+    max_keys, except for the keys refreshed on a schedule.
+    """
+
+    def __init__(self, compute, max_age=datetime.timedelta(minutes=5), idle_timeout=None, max_keys=None):
+        self.compute = compute
+        self.max_age = max_age
+        self.idle_timeout = idle_timeout
+        self.max_keys = max_keys
+        self._log = logging.getLogger(__name__)
+        self._results = {}
+        self._requested = {}
+        self._scheduled = set()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._refreshed = threading.Condition(self._lock)
+        self._stopped = threading.Event()
+        self._scheduler = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._results)
+
+    def results(self):
+        with self._lock:
+            return self._results.values()
+
+    def get(self, key, now=None):
+        # None if there never was a result for the key, refresh(key) waits for the first one
+        with self._lock:
+            self._request(key, now)
+            result = self._results.get(key)
+        if result is not None and result.age(now) > self.max_age:
+            self.refresh_async(key)
+        return result
+
+    def refresh(self, key):
+        with self._lock:
+            self._request(key)
+            if key in self._refreshing:
+                # serve the last result, or wait for the first one
+                while key in self._refreshing and key not in self._results:
+                    self._refreshed.wait()
+                return self._results.get(key)
+            self._refreshing.add(key)
+        return self._refresh(key)
+
+    def store(self, key, value):
+        # a result computed elsewhere, e.g. while streaming it to a client
+        result = CachedResult(value, datetime.datetime.now())
+        with self._lock:
+            self._request(key)
+            self._results[key] = result
+        return result
+
+    def _request(self, key, now=None):
+        # called with the lock held
+        now = now or datetime.datetime.now()
+        self._requested[key] = now
+        self._evict(now)
+
+    def _evict(self, now):
+        keys = set(self._results) | set(self._requested)
+        evicted = [key for key in keys if key not in self._scheduled and self.idle_timeout is not None and
+                   now - self._requested.get(key, datetime.datetime.min) > self.idle_timeout]
+        if self.max_keys is not None:
+            kept = sorted((key for key in keys if key not in self._scheduled and key not in evicted),
+                          key=lambda key: self._requested.get(key, datetime.datetime.min))
+            evicted.extend(kept[:max(0, len(kept) - self.max_keys)])
+        for key in evicted:
+            self._results.pop(key, None)
+            self._requested.pop(key, None)
+        return len(evicted)
+
+    def evict_idle(self, now=None):
+        with self._lock:
+            return self._evict(now or datetime.datetime.now())
+
+    def refresh_async(self, key):
+        with self._lock:
+            if key in self._refreshing:
+                return None
+            self._refreshing.add(key)
+        thread = threading.Thread(target=self._refresh, args=(key,), name='refresh %s' % (key,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _refresh(self, key):
+        try:
+            result = CachedResult(self.compute(key), datetime.datetime.now())
+            with self._lock:
+                self._results[key] = result
+            return result
+        except Exception:
+            self._log.exception('refreshing %s failed, keeping the last result', key)
+            with self._lock:
+                return self._results.get(key)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+                self._refreshed.notify_all()
+
+    def is_refreshing(self, key):
+        with self._lock:
+            return key in self._refreshing
+
+    def start(self, keys, interval=datetime.timedelta(minutes=5)):
+        # keep the keys fresh on a schedule, independent of page views
+        if self._scheduler:
+            return self._scheduler
+        self._stopped.clear()
+        with self._lock:
+            self._scheduled = set(keys)
+
+        def schedule():
+            while not self._stopped.is_set():
+                for key in keys:
+                    if self._stopped.is_set():
+                        break
+                    self.refresh(key)
+                self._stopped.wait(interval.total_seconds())
+
+        self._scheduler = threading.Thread(target=schedule, name='refresh schedule')
+        self._scheduler.daemon = True
+        self._scheduler.start()
+        return self._scheduler
+
+    def stop(self):
+        self._stopped.set()
+        if self._scheduler:
+            self._scheduler.join()
+            self._scheduler = None
@@ -0,0 +1,189 @@
+import datetime
+import sys
+import threading
+
+from quantiles import PERCENTILES, TDigest, merge_digests
+from shared_cache import LeaseTimeout
+
+ONE_DAY = datetime.timedelta(days=1)
+
+
+class DailyRollup(object):
+    def __init__(self):
+        self.count = 0
+        self.cycle_time_sum = datetime.timedelta()
+        self.digest = TDigest()
+        self.issue_ids = set()
+
+    def add(self, issue):
+        self.issue_ids.add(issue.issue_id)
+        self.count += 1
+        self.cycle_time_sum += issue.cycle_time
+        self.digest.add(issue.cycle_time.days)
+
+
+class RangeRollup(object):
+    def __init__(self, daily_rollups):
+        self.days = len(daily_rollups)
+        self.count = sum(rollup.count for rollup in daily_rollups)
+        self.cycle_time_sum = sum((rollup.cycle_time_sum for rollup in daily_rollups), datetime.timedelta())
+        self.digest = merge_digests(rollup.digest for rollup in daily_rollups)
+
+    @property
+    def mean_cycle_time(self):
+        if not self.count:
+            return None
+        return self.cycle_time_sum / self.count
+
+    def percentiles(self, quantiles=PERCENTILES):
+        if not self.count:
+            return []
+        return zip(quantiles, self.digest.percentiles(quantiles))
+
+
+class ProjectRollups(object):
+    """
+    Finished issues of one project aggregated per resolved day: count, cycle time sum and a quantile sketch.
+    Remembers the intervals of days that have been fetched, so that only missing days need to be fetched again.
+    """
+
+    def __init__(self):
+        self.days = {}
+        self.issue_ids = set()
+        # sorted, disjoint and not adjacent (first_day, last_day) intervals
+        self.fetched = []
+
+    @classmethod
+    def from_days(cls, fetched, days):
+        rollups = cls()
+        rollups.days = dict(days)
+        for rollup in rollups.days.itervalues():
+            rollups.issue_ids.update(rollup.issue_ids)
+        for first_day, last_day in fetched:
+            rollups.mark_fetched(first_day, last_day)
+        return rollups
+
+    def add(self, issues):
+        # the days that changed
+        changed = set()
+        for issue in issues:
+            if issue.issue_id in self.issue_ids:
+                continue
+            self.issue_ids.add(issue.issue_id)
+            day = issue.resolved_date.date()
+            self.days.setdefault(day, DailyRollup()).add(issue)
+            changed.add(day)
+        return changed
+
+    def missing_ranges(self, first_day, last_day):
+        covered = list(self.fetched)
+        if covered:
+            # the last fetched day may not have been over yet
+            start, end = covered.pop()
+            if start < end:
+                covered.append((start, end - ONE_DAY))
+        ranges = []
+        day = first_day
+        for start, end in covered:
+            if start > last_day:
+                break
+            if end < day:
+                continue
+            if start > day:
+                ranges.append((day, start - ONE_DAY))
+            day = end + ONE_DAY
+        if day <= last_day:
+            ranges.append((day, last_day))
+        return ranges
+
+    def mark_fetched(self, first_day, last_day):
+        merged = []
+        for start, end in sorted(self.fetched + [(first_day, last_day)]):
+            if merged and start <= merged[-1][1] + ONE_DAY:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        self.fetched = merged
+
+    def between(self, first_day, last_day):
+        return [rollup for day, rollup in self.days.iteritems() if first_day <= day <= last_day]
+
+
+class RollupStore(object):
+    def __init__(self, shared_cache=None, owner='', wait=datetime.timedelta(seconds=10)):
+        # with a shared cache the rollups of a project are fetched by one process and read by the others, which wait
+        # for at most wait and then serve the days stored so far. The stores of different users keep theirs apart.
+        self.shared_cache = shared_cache
+        self.owner = owner
+        self.wait = wait
+        self.projects = {}
+        # a project's fetches hold its own lock, the store lock only guards merging and reading the rollups
+        self._project_locks = {}
+        self._lock = threading.Lock()
+
+    def _project_lock(self, project):
+        with self._lock:
+            return self._project_locks.setdefault(project, threading.Lock())
+
+    def refresh(self, yt, project, then, now, items=1000):
+        with self._project_lock(project):
+            if self.shared_cache is None:
+                with self._lock:
+                    rollups = self.projects.setdefault(project, ProjectRollups())
+                self._fetch_missing(yt, project, rollups, then, now, items)
+                return rollups
+            key = 'rollups %s %s' % (self.owner, project)
+            try:
+                with self.shared_cache.lock(key, self.wait):
+                    rollups = self._load_shared(key)
+                    changed = self._fetch_missing(yt, project, rollups, then, now, items)
+                    # the fetched range and the days that changed, the others are stored already and only expire
+                    # together with the range
+                    self.shared_cache.put_many([(key, rollups.fetched)] +
+                                               [(day_key(key, day), rollups.days[day]) for day in changed],
+                                               touch=[day_key(key, day) for day in rollups.days if day not in changed])
+            except LeaseTimeout:
+                rollups = self._load_shared(key)
+            with self._lock:
+                self.projects[project] = rollups
+            return rollups
+
+    def _load_shared(self, key):
+        fetched = self.shared_cache.get(key)
+        if fetched is None:
+            return ProjectRollups()
+        keys = dict((day_key(key, day), day) for first_day, last_day in fetched.value
+                    for day in days_between(first_day, last_day))
+        return ProjectRollups.from_days(fetched.value, [
+            (keys[stored], result.value) for stored, result in self.shared_cache.get_many(keys).iteritems()])
+
+    def _fetch_missing(self, yt, project, rollups, then, now, items):
+        changed = set()
+        for first_day, last_day in rollups.missing_ranges(to_date(then), to_date(now)):
+            # pages of items until the range is exhausted, a range cut off at items would stay incomplete for good
+            issues = list(yt.iter_cycle_time_issues(project, sys.maxint, history_range=(
+                last_day.strftime('%Y-%m-%d'), first_day.strftime('%Y-%m-%d')), batch_size=items))
+            with self._lock:
+                changed.update(rollups.add(issues))
+                rollups.mark_fetched(first_day, last_day)
+        return changed
+
+    def range(self, projects, then, now):
+        daily_rollups = []
+        with self._lock:
+            for project in projects:
+                if project in self.projects:
+                    daily_rollups.extend(self.projects[project].between(to_date(then), to_date(now)))
+        return RangeRollup(daily_rollups)
+
+
+def to_date(value):
+    return value.date() if isinstance(value, datetime.datetime) else value
+
+
+def days_between(first_day, last_day):
+    return [first_day + datetime.timedelta(days=offset) for offset in range((last_day - first_day).days + 1)]
+
+
+def day_key(key, day):
+    return '%s %s' % (key, day.strftime('%Y-%m-%d'))
@@ -0,0 +1,82 @@
+import datetime
+import hashlib
+import hmac
+import os
+import threading
+import uuid
+
+
+class ConnectionRegistry(object):
+    """
+    Connections of logged in users, looked up by an opaque session token. Logins with the same credentials share
+    one connection (and its pool of transports), connections unused for idle_timeout are evicted.
+    """
+
+    def __init__(self, connect, idle_timeout=datetime.timedelta(minutes=30)):
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self._secret = os.urandom(16)
+        self._sessions = {}
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._connections)
+
+    def login(self, username, password, now=None):
+        now = now or datetime.datetime.now()
+        self.evict_idle(now)
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        key = (username, hmac.new(self._secret, password, hashlib.sha256).hexdigest())
+        with self._lock:
+            entry = self._connections.get(key)
+        if entry is None:
+            # the login round trip happens outside the lock, other users are not blocked by it
+            connection = self.connect(username, password)
+            with self._lock:
+                entry = self._connections.setdefault(key, [connection, now])
+        token = uuid.uuid4().hex
+        with self._lock:
+            entry[1] = now
+            self._sessions[token] = key
+        return token
+
+    def get(self, token, now=None):
+        now = now or datetime.datetime.now()
+        self.evict_idle(now)
+        with self._lock:
+            key = self._sessions.get(token)
+            entry = self._connections.get(key)
+            if entry is None:
+                self._sessions.pop(token, None)
+                return None
+            entry[1] = now
+            return entry[0]
+
+    def logout(self, token):
+        with self._lock:
+            key = self._sessions.pop(token, None)
+            if key not in self._sessions.values():
+                self._connections.pop(key, None)
+
+    def for_login(self, username):
+        # the most recently used connection of a user, for work done on their behalf outside of a request
+        with self._lock:
+            entries = [entry for (login, _), entry in self._connections.items() if login == username]
+            if not entries:
+                return None
+            return max(entries, key=lambda entry: entry[1])[0]
+
+    def evict_idle(self, now=None):
+        now = now or datetime.datetime.now()
+        with self._lock:
+            idle = [key for key, (connection, last_used) in self._connections.items()
+                    if now - last_used > self.idle_timeout]
+            for key in idle:
+                del self._connections[key]
+            for token, key in self._sessions.items():
+                if key not in self._connections:
+                    del self._sessions[token]
+            return len(idle)
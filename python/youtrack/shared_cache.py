@@ -0,0 +1,177 @@
+import cPickle
+import datetime
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from refresh import CachedResult
+
+
+class LeaseTimeout(Exception):
+    pass
+
+
+class SharedCache(object):
+    """
+    Pickled values in a SQLite database in WAL mode, shared by the worker processes of one host.
+
+    Every value is written in a single transaction, so readers see either the old or the new value. A lease per key
+    makes sure only one process computes a value while the others read the last one (or wait for the first one).
+    A held lease is renewed until it is released, a crashed worker does not block the others for longer than lease.
+    Entries that were neither written nor touched for lifetime are deleted, as are expired leases, on every write.
+    """
+
+    def __init__(self, filename, lease=datetime.timedelta(minutes=10), poll_interval=0.1,
+                 lifetime=datetime.timedelta(days=1)):
+        self.filename = filename
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.lifetime = lifetime
+        self._local = threading.local()
+        with self._transaction() as database:
+            database.execute('CREATE TABLE IF NOT EXISTS entries '
+                             '(key TEXT PRIMARY KEY, value BLOB, computed REAL, expires REAL)')
+            if 'expires' not in [column[1] for column in database.execute('PRAGMA table_info(entries)')]:
+                # a file written before entries expired
+                database.execute('ALTER TABLE entries ADD COLUMN expires REAL')
+                database.execute('UPDATE entries SET expires = computed + ?', (lifetime.total_seconds(),))
+            database.execute('CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)')
+            database.execute('CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+
+    def _database(self):
+        # sqlite connections must neither cross threads nor forks
+        database = getattr(self._local, 'database', None)
+        if database is None or self._local.pid != os.getpid():
+            database = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+            database.execute('PRAGMA journal_mode=WAL')
+            database.execute('PRAGMA synchronous=NORMAL')
+            self._local.database = database
+            self._local.pid = os.getpid()
+        return database
+
+    @contextmanager
+    def _transaction(self):
+        database = self._database()
+        # IMMEDIATE takes the write lock up front, concurrent writers wait for each other instead of failing
+        database.execute('BEGIN IMMEDIATE')
+        try:
+            yield database
+        except Exception:
+            database.execute('ROLLBACK')
+            raise
+        database.execute('COMMIT')
+
+    def _owner(self):
+        return '%d:%d' % (os.getpid(), threading.current_thread().ident)
+
+    def get(self, key):
+        row = self._database().execute('SELECT value, computed FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return CachedResult(cPickle.loads(str(row[0])), datetime.datetime.fromtimestamp(row[1]))
+
+    def get_many(self, keys):
+        # {key: CachedResult} of the keys that have a value
+        results = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            for key, value, computed in self._database().execute(
+                    'SELECT key, value, computed FROM entries WHERE key IN (%s)' % ', '.join('?' * len(chunk)), chunk):
+                results[key] = CachedResult(cPickle.loads(str(value)), datetime.datetime.fromtimestamp(computed))
+        return results
+
+    def put(self, key, value):
+        return self.put_many([(key, value)])[0]
+
+    def put_many(self, items, touch=()):
+        # all values in one transaction, the touched keys keep their values but live for another lifetime
+        computed = time.time()
+        expires = computed + self.lifetime.total_seconds()
+        results = []
+        touch = list(touch)
+        with self._transaction() as database:
+            for key, value in items:
+                data = sqlite3.Binary(cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL))
+                database.execute('INSERT OR REPLACE INTO entries (key, value, computed, expires) VALUES (?, ?, ?, ?)',
+                                 (key, data, computed, expires))
+                results.append(CachedResult(value, datetime.datetime.fromtimestamp(computed)))
+            for start in range(0, len(touch), 500):
+                chunk = touch[start:start + 500]
+                database.execute('UPDATE entries SET expires = ? WHERE key IN (%s)' % ', '.join('?' * len(chunk)),
+                                 [expires] + chunk)
+            database.execute('DELETE FROM entries WHERE expires < ?', (computed,))
+            database.execute('DELETE FROM leases WHERE expires < ?', (computed,))
+        return results
+
+    def __len__(self):
+        return self._database().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def try_acquire(self, key):
+        now = time.time()
+        with self._transaction() as database:
+            row = database.execute('SELECT owner, expires FROM leases WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[0] != self._owner() and row[1] > now:
+                return False
+            database.execute('INSERT OR REPLACE INTO leases (key, owner, expires) VALUES (?, ?, ?)',
+                             (key, self._owner(), now + self.lease.total_seconds()))
+            return True
+
+    def renew(self, key, owner):
+        with self._transaction() as database:
+            return database.execute('UPDATE leases SET expires = ? WHERE key = ? AND owner = ?', (
+                time.time() + self.lease.total_seconds(), key, owner)).rowcount > 0
+
+    def release(self, key, owner=None):
+        with self._transaction() as database:
+            database.execute('DELETE FROM leases WHERE key = ? AND owner = ?', (key, owner or self._owner()))
+
+    @contextmanager
+    def lock(self, key, timeout=None):
+        # waiting for another worker's lease raises LeaseTimeout after timeout
+        deadline = None if timeout is None else time.time() + timeout.total_seconds()
+        while not self.try_acquire(key):
+            if deadline is not None and time.time() >= deadline:
+                raise LeaseTimeout('%s is still leased by another worker' % key)
+            time.sleep(self.poll_interval)
+        with self._held(key):
+            yield
+
+    @contextmanager
+    def _held(self, key):
+        # the lease of an acquired key is renewed while it is computed, however long that takes, and released after
+        owner = self._owner()
+        released = threading.Event()
+
+        def renew():
+            while not released.wait(self.lease.total_seconds() / 3):
+                self.renew(key, owner)
+
+        renewal = threading.Thread(target=renew, name='lease %s' % key)
+        renewal.daemon = True
+        renewal.start()
+        try:
+            yield
+        finally:
+            released.set()
+            renewal.join()
+            self.release(key, owner)
+
+    def get_or_compute(self, key, compute, max_age):
+        result = self.get(key)
+        if result is not None and result.age() <= max_age:
+            return result
+        if result is not None and not self.try_acquire(key):
+            # another worker is computing it, the last value is good enough meanwhile
+            return result
+        if result is None:
+            with self.lock(key):
+                # the worker holding the lease may have stored it while we waited
+                result = self.get(key)
+                if result is not None:
+                    return result
+                return self.put(key, compute())
+        with self._held(key):
+            return self.put(key, compute())
@@ -0,0 +1,57 @@
+import sys
+import threading
+
+from instrumentation import REGISTRY
+
+SUPPRESSED_CALLS = REGISTRY.counter('youtrack_single_flight_suppressed_total',
+                                    'Calls that waited for an identical call in flight instead of fetching again',
+                                    ('operation',))
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces identical concurrent calls: the first call for a key runs, calls for the same key arriving while it is
+    in flight wait for it and share its result (or exception). Nothing is cached once the call has returned.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.suppressed += 1
+        if not leader:
+            SUPPRESSED_CALLS.inc(key[0])
+            call.done.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except Exception:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+# shared by all connections of a process, keys start with the operation and the YouTrack url and login
+FLIGHTS = SingleFlight()
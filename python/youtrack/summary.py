@@ -0,0 +1,105 @@
+import datetime
+from bisect import bisect_left
+from operator import attrgetter
+
+import numpy
+
+from flow import daily_flow
+from quantiles import PERCENTILES, cycle_time_digest
+
+
+class SummaryStatistics(object):
+    def __init__(self, issues, now, then):
+        if not issues:
+            raise ValueError('no issues to summarize')
+        self.now = now
+        self.then = then
+        self.timespan = (now - then).days
+        self.finished = len(issues)
+
+        self.oldest_issue = self.youngest_issue = self.min_issue = self.max_issue = issues[0]
+        self.started = 0
+        cycle_times = numpy.empty(len(issues), dtype=numpy.int64)
+        for index, issue in enumerate(issues):
+            cycle_times[index] = issue.cycle_time.days
+            if issue.resolved_date < self.oldest_issue.resolved_date:
+                self.oldest_issue = issue
+            if issue.resolved_date > self.youngest_issue.resolved_date:
+                self.youngest_issue = issue
+            if issue.cycle_time.days < self.min_issue.cycle_time.days:
+                self.min_issue = issue
+            if issue.cycle_time.days > self.max_issue.cycle_time.days:
+                self.max_issue = issue
+            if issue.cycle_time_start > then:
+                self.started += 1
+
+        median_index = len(issues) // 2
+        self.median_issue = issues[numpy.argpartition(cycle_times, median_index)[median_index]]
+        self.mean_cycle_time = cycle_times.mean()
+        self.flow = daily_flow(issues, then, now)
+        self.mean_wip = self.flow.mean_wip
+        self.max_wip = self.flow.max_wip
+        self.pull_rate = self.started / float(self.timespan) * 7
+
+    def lines(self):
+        return ['oldest issue  : %s' % self.oldest_issue,
+                'youngest issue: %s' % self.youngest_issue,
+                'min issue     : %s' % self.min_issue,
+                'median issue  : %s' % self.median_issue,
+                'max issue     : %s' % self.max_issue,
+                'timespan (%s - %s): %d days' % (self.now, self.then, self.timespan),
+                'number of finished issues: %d' % self.finished,
+                'number of started issues: %d' % self.started,
+                'mean cycle time: %d days' % self.mean_cycle_time,
+                'mean WiP: %.2f items' % self.mean_wip,
+                'max WiP: %d items' % self.max_wip,
+                'pull rate: %.2f issues per week' % self.pull_rate]
+
+    def __str__(self):
+        return '\n'.join(self.lines())
+
+
+def window_slices(issues, windows):
+    # windows are (now, then) pairs, an issue belongs to every window whose days include its resolved date
+    issues = sorted(issues, key=attrgetter('resolved_date'))
+    resolved_dates = [issue.resolved_date for issue in issues]
+    slices = []
+    for now, then in windows:
+        lower = bisect_left(resolved_dates, datetime.datetime.combine(then.date(), datetime.time.min))
+        upper = bisect_left(resolved_dates, datetime.datetime.combine(now.date() + datetime.timedelta(days=1),
+                                                                      datetime.time.min))
+        slices.append(issues[lower:upper])
+    return slices
+
+
+class WindowComparison(object):
+    def __init__(self, issues, windows, quantiles=PERCENTILES):
+        self.windows = windows
+        self.quantiles = quantiles
+        self.issues = window_slices(issues, windows)
+        self.summaries = [SummaryStatistics(window_issues, now, then) if window_issues else None
+                          for window_issues, (now, then) in zip(self.issues, windows)]
+        self.percentiles = [cycle_time_digest(window_issues).percentiles(quantiles) if window_issues else None
+                            for window_issues in self.issues]
+
+    def lines(self):
+        rows = [('window', ['%s - %s' % (then.date(), now.date()) for now, then in self.windows])]
+        for label, value in (('finished issues', lambda summary: '%d' % summary.finished),
+                             ('started issues', lambda summary: '%d' % summary.started),
+                             ('mean cycle time', lambda summary: '%d days' % summary.mean_cycle_time),
+                             ('median cycle time', lambda summary: '%d days' % summary.median_issue.cycle_time.days),
+                             ('max cycle time', lambda summary: '%d days' % summary.max_issue.cycle_time.days),
+                             ('mean WiP', lambda summary: '%.2f items' % summary.mean_wip),
+                             ('max WiP', lambda summary: '%d items' % summary.max_wip),
+                             ('pull rate', lambda summary: '%.2f per week' % summary.pull_rate)):
+            rows.append((label, [value(summary) if summary else '-' for summary in self.summaries]))
+        for index, quantile in enumerate(self.quantiles):
+            rows.append(('%d%% percentile' % quantile,
+                         ['%.1f days' % percentiles[index] if percentiles is not None else '-'
+                          for percentiles in self.percentiles]))
+        width = max(len(column) for label, columns in rows for column in columns)
+        return ['%-20s%s' % (label, ''.join('%*s' % (width + 2, column) for column in columns))
+                for label, columns in rows]
+
+    def __str__(self):
+        return '\n'.join(self.lines())